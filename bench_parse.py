@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Garden Stock Bot - бенчмарк разбора ответа API
+Сравнивает JSON декодеры (полные и частичные, только массивы стока) и
+конвейер format_stocks -> parse_formatted_stock_data с однопроходным
+extract_tracked_stock: время и пик выделенной памяти на один опрос.
+
+Использование:
+    python bench_parse.py                       # синтетический ответ API
+    python bench_parse.py snapshot.json.gz      # записанный ответ (например, из debug_snapshots/)
+    python bench_parse.py -n 5000
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def load_main():
+    """Импортирует main.py из временного каталога, чтобы не трогать файлы состояния бота"""
+    sys.path.insert(0, REPO_DIR)
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp(prefix='garden-bench-'))
+    try:
+        import main
+    finally:
+        os.chdir(cwd)
+    # Логи разбора одинаково отключены для обоих вариантов
+    logging.disable(logging.INFO)
+    return main
+
+def read_payload(path):
+    """Читает записанный ответ API (.json или .json.gz) как байты"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        return f.read()
+
+def synthetic_payload(bot_main, seed=1):
+    """Строит ответ API, похожий на настоящий: стоки, lastSeen и imageData"""
+    rnd = random.Random(seed)
+    names = sorted(bot_main.bot.tracked.items) + [f"filler item {i}" for i in range(60)]
+
+    def stock(count):
+        return [{'name': rnd.choice(names).title(), 'value': rnd.randint(1, 20)} for _ in range(count)]
+
+    def last_seen(count):
+        return [
+            {'name': rnd.choice(names).title(), 'emoji': '🌱', 'seen': '2024-01-01T00:00:00.000Z'}
+            for _ in range(count)
+        ]
+
+    payload = {category: stock(15) for category in bot_main.STOCK_CATEGORIES}
+    payload['lastSeen'] = {key: last_seen(40) for key in ('Seeds', 'Gears', 'Weather', 'Eggs', 'Honey')}
+    payload['imageData'] = {
+        name.title(): f"https://growagarden.gg/images/{name.replace(' ', '_')}.png" for name in names
+    }
+    payload['restockTimers'] = {'seeds': 300000, 'gears': 300000, 'eggs': 1800000}
+    return json.dumps(payload).encode('utf-8')
+
+def measure(fn, argument, iterations):
+    """Среднее время вызова (мкс) и пик выделенной за вызов памяти (байты)"""
+    fn(argument)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn(argument)
+    elapsed = (time.perf_counter() - started) / iterations * 1e6
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    fn(argument)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return elapsed, peak
+
+def print_table(title, rows):
+    print(f"\n{title}")
+    print(f"{'Вариант':<40}{'мкс/опрос':>12}{'пик, КиБ':>12}")
+    for name, elapsed, peak in rows:
+        print(f"{name:<40}{elapsed:>12.1f}{peak / 1024:>12.1f}")
+
+def bench_decoders(bot_main, body, iterations):
+    rows = [('json.loads (полный)', *measure(json.loads, body, iterations))]
+    if bot_main.orjson is not None:
+        rows.append(('orjson.loads (полный)', *measure(bot_main.orjson.loads, body, iterations)))
+    if bot_main.msgspec is not None:
+        rows.append(('msgspec.json.decode (полный)', *measure(bot_main.msgspec.json.decode, body, iterations)))
+
+    reference = bot_main.extract_tracked_stock(json.loads(body), bot_main.bot.tracked)
+    for name, decoder in bot_main.STOCK_DECODERS.items():
+        decoded = decoder(body)
+        if bot_main.extract_tracked_stock(decoded, bot_main.bot.tracked) != reference:
+            raise SystemExit(f"❌ Декодер {name} дает другой результат")
+        rows.append((f"stock:{name}", *measure(decoder, body, iterations)))
+
+    print_table(f"Декодирование ответа (по умолчанию: stock:{bot_main.STOCK_DECODER})", rows)
+
+def bench_extraction(bot_main, raw_data, iterations):
+    bot = bot_main.bot
+
+    def pipeline(data):
+        return bot.parse_formatted_stock_data(bot.format_stocks(data))
+
+    def fused(data):
+        return bot_main.extract_tracked_stock(data, bot.tracked)
+
+    if pipeline(raw_data) != bot_main.flatten_stock(fused(raw_data)):
+        raise SystemExit("❌ Результаты конвейеров не совпадают")
+
+    print_table("Извлечение отслеживаемых предметов", [
+        ('format_stocks + parse_formatted', *measure(pipeline, raw_data, iterations)),
+        ('extract_tracked_stock', *measure(fused, raw_data, iterations)),
+    ])
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк разбора ответа API стока')
+    parser.add_argument('payload', nargs='?', help='записанный ответ API (.json или .json.gz)')
+    parser.add_argument('-n', '--iterations', type=int, default=2000, help='число повторов')
+    args = parser.parse_args()
+
+    bot_main = load_main()
+    body = read_payload(args.payload) if args.payload else synthetic_payload(bot_main)
+    print(f"📦 Размер ответа: {len(body) / 1024:.1f} КиБ, повторов: {args.iterations}")
+
+    bench_decoders(bot_main, body, args.iterations)
+    bench_extraction(bot_main, json.loads(body), args.iterations)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+"""
+Garden Stock Bot - процессы доставки сообщений
+Шардированная рассылка: каналы делятся между процессами консистентным
+хешированием, общий лимит Telegram делится через разделяемую память.
+Модуль не импортирует main.py, чтобы дочерние процессы не поднимали бота.
+"""
+
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import time
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+class ConsistentHashRing:
+    """Консистентное хеширование ключей по узлам
+
+    Каждый узел занимает replicas точек на кольце. При изменении числа
+    узлов переезжает примерно 1/N ключей, остальные остаются на месте.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.ring = sorted((self.hash(f"{node}:{replica}"), node) for node in nodes for replica in range(replicas))
+        self.hashes = [point for point, _ in self.ring]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def node_for(self, key):
+        index = bisect.bisect(self.hashes, self.hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+class SharedTokenBucket:
+    """Token bucket, общий для всех процессов доставки
+
+    Состояние лежит в разделяемой памяти под одним межпроцессным Lock,
+    поэтому процессы вместе не превышают rate сообщений в секунду (всплеск -
+    capacity, как у TokenBucket в main.py).
+    pause() останавливает всех после 429 от Telegram.
+    """
+
+    def __init__(self, rate=30, capacity=1, context=None):
+        context = context or multiprocessing.get_context()
+        self.rate = rate
+        self.capacity = capacity
+        self.lock = context.Lock()
+        self.tokens = context.RawValue('d', self.capacity)
+        self.updated = context.RawValue('d', time.time())
+        self.paused_until = context.RawValue('d', 0.0)
+        self.acquired = context.RawValue('Q', 0)
+
+    def try_acquire(self):
+        """Берет токен; возвращает 0 или сколько секунд ждать"""
+        with self.lock:
+            now = time.time()
+            if now < self.paused_until.value:
+                return self.paused_until.value - now
+            elapsed = max(0.0, now - self.updated.value)
+            self.tokens.value = min(self.capacity, self.tokens.value + elapsed * self.rate)
+            self.updated.value = now
+            if self.tokens.value >= 1:
+                self.tokens.value -= 1
+                self.acquired.value += 1
+                return 0.0
+            return (1 - self.tokens.value) / self.rate
+
+    async def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until.value = max(self.paused_until.value, time.time() + seconds)
+
+class BotApiError(Exception):
+    def __init__(self, code, description, retry_after=None):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.retry_after = retry_after
+
+class DeliveryWorker:
+    """Процесс доставки: свои соединения, очередь и лимит на канал
+
+    Задания приходят через multiprocessing.Queue, результаты уходят в общую
+    очередь результатов кортежами:
+    ('delivered', job_id, message_id), ('deferred', job_id),
+    ('failed', job_id, ошибка, permanent). Повторы после 429 и сетевых
+    ошибок выполняются здесь же, главный процесс узнает только итог.
+    """
+
+    def __init__(self, shard, api_url, jobs, results, budget, concurrency=8, per_chat_interval=1.0,
+                 max_attempts=6, retry_base=2.0, retry_max=300.0, permanent_errors=()):
+        self.shard = shard
+        self.api_url = api_url.rstrip('/')
+        self.jobs = jobs
+        self.results = results
+        self.budget = budget
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.permanent_errors = tuple(permanent_errors)
+        self.chat_next = {}
+        self.queue = None
+        self.session = None
+        self._seq = 0
+
+    async def run(self):
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        self.queue = asyncio.PriorityQueue()
+        tasks = [asyncio.create_task(self._consume()) for _ in range(self.concurrency)]
+        loop = asyncio.get_running_loop()
+        logger.info(f"📮 Процесс доставки #{self.shard} запущен")
+        try:
+            while True:
+                job = await loop.run_in_executor(None, self.jobs.get)
+                if job is None:
+                    break
+                self._enqueue(job)
+        finally:
+            # Недоставленное остается в журнале главного процесса
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.session.close()
+            logger.info(f"📮 Процесс доставки #{self.shard} остановлен")
+
+    def _enqueue(self, job):
+        self._seq += 1
+        self.queue.put_nowait((-job.get('priority', 0), self._seq, job))
+
+    async def _consume(self):
+        while True:
+            _, _, job = await self.queue.get()
+            try:
+                await self._deliver(job)
+            except Exception as e:
+                logger.error(f"❌ Ошибка процесса доставки #{self.shard}: {e}")
+                self._retry(job)
+            finally:
+                self.queue.task_done()
+
+    async def _wait_chat(self, chat_id):
+        """Интервал между сообщениями в один канал"""
+        now = time.monotonic()
+        ready = max(now, self.chat_next.get(chat_id, 0.0))
+        self.chat_next[chat_id] = ready + self.per_chat_interval
+        if ready > now:
+            await asyncio.sleep(ready - now)
+
+    async def call(self, method, payload):
+        async with self.session.post(f"{self.api_url}/{method}", json=payload) as response:
+            try:
+                data = await response.json(content_type=None)
+            except ValueError:
+                # Прокси или балансировщик ответил не JSON
+                raise BotApiError(response.status, await response.text())
+        if data.get('ok'):
+            return data.get('result')
+        parameters = data.get('parameters') or {}
+        raise BotApiError(data.get('error_code', response.status), data.get('description', ''), parameters.get('retry_after'))
+
+    async def send_or_edit(self, job):
+        """Отправляет сообщение или правит опубликованное (как Broadcaster._send_or_edit)"""
+        chat_id = job['chat_id']
+        text = {'chat_id': chat_id, 'text': job['text'], 'parse_mode': 'Markdown', 'disable_web_page_preview': True}
+        if job.get('edit_message_id'):
+            try:
+                await self.call('editMessageText', {**text, 'message_id': job['edit_message_id']})
+                return job['edit_message_id']
+            except BotApiError as e:
+                description = e.description.lower()
+                if 'not modified' in description:
+                    return job['edit_message_id']
+                if 'message to edit not found' not in description and "can't be edited" not in description:
+                    raise
+                job['edit_message_id'] = None
+                await self.budget.acquire()
+
+        message = await self.call('sendMessage', text)
+        if job.get('board'):
+            # Повтор задания поправит опубликованное табло, а не отправит второе
+            job['edit_message_id'] = message['message_id']
+            try:
+                await self.budget.acquire()
+                await self.call('pinChatMessage', {
+                    'chat_id': chat_id,
+                    'message_id': message['message_id'],
+                    'disable_notification': True
+                })
+            except (BotApiError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"⚠️ Не удалось закрепить табло в канале {chat_id}: {e}")
+        return message['message_id']
+
+    async def _deliver(self, job):
+        chat_id = job['chat_id']
+        await self._wait_chat(chat_id)
+        await self.budget.acquire()
+        try:
+            message_id = await self.send_or_edit(job)
+        except BotApiError as e:
+            if e.code == 429:
+                delay = float(e.retry_after or 1)
+                logger.warning(f"⏳ Лимит Telegram, пауза {delay:.0f} сек. (канал {chat_id}, процесс #{self.shard})")
+                self.budget.pause(delay)
+                self.chat_next[chat_id] = time.monotonic() + delay
+                self._retry(job, delay)
+            elif e.code in (400, 401, 403):
+                permanent = e.code in (401, 403) or any(err in e.description for err in self.permanent_errors)
+                self.results.put(('failed', job['id'], e.description, permanent))
+            else:
+                self._retry(job)
+            return
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"⚠️ Сетевая ошибка при отправке в {chat_id} (попытка {job['attempts'] + 1}): {e}")
+            self._retry(job)
+            return
+        self.results.put(('delivered', job['id'], message_id))
+
+    def _retry(self, job, delay=None):
+        job['attempts'] += 1
+        if job['attempts'] >= self.max_attempts:
+            self.results.put(('failed', job['id'], "превышено число попыток", False))
+            return
+        if delay is None:
+            delay = min(self.retry_max, self.retry_base * 2 ** (job['attempts'] - 1))
+        self.results.put(('deferred', job['id']))
+        asyncio.get_running_loop().call_later(delay, self._enqueue, job)
+
+def run_worker(shard, api_url, jobs, results, budget, options):
+    """Точка входа дочернего процесса"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - shard{shard} - %(levelname)s - %(message)s'
+    )
+    try:
+        asyncio.run(DeliveryWorker(shard, api_url, jobs, results, budget, **options).run())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Garden Stock Bot - локальный фейковый Bot API
+Отвечает на sendMessage, editMessageText и pinChatMessage как Telegram:
+задержка ответа, общий лимит сообщений в секунду с 429 и retry_after,
+случайные 5xx и "chat not found". Нужен для проверки рассылки (в том
+числе ShardedBroadcaster) без настоящего Telegram.
+
+Использование:
+    python fake_telegram.py --port 8081 --rate 30 --latency 50
+    # в config.py: TELEGRAM_API_URL = 'http://127.0.0.1:8081/bot'
+    curl http://127.0.0.1:8081/stats
+"""
+
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import random
+import time
+
+from aiohttp import web
+
+class FakeTelegram:
+    """Фейковый Bot API сервер со статистикой запросов"""
+
+    def __init__(self, latency=0.0, jitter=0.0, rate=30, chat_interval=0.0, retry_after=1,
+                 error_rate=0.0, missing_chats=(), seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.missing_chats = {str(chat) for chat in missing_chats}
+        self.random = random.Random(seed)
+        self.requests = collections.Counter()
+        self.limited = 0
+        self.errors = 0
+        self.messages = {}
+        self.per_chat = collections.Counter()
+        self.recent = collections.deque()
+        self.chat_last = {}
+        self.message_ids = itertools.count(1)
+        self.started = time.time()
+        # on_delivery(method, chat_id, text, at) - для нагрузочного теста
+        self.on_delivery = None
+        self.runner = None
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/stats', self.handle_stats)
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        return app
+
+    async def start(self, host='127.0.0.1', port=8081):
+        """Запускает сервер в текущем event loop; возвращает base_url для Bot API"""
+        self.runner = web.AppRunner(self.app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}/bot"
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    @staticmethod
+    async def read_params(request):
+        if request.content_type == 'application/json':
+            return await request.json()
+        params = {}
+        for key, value in (await request.post()).items():
+            # python-telegram-bot шлет форму, значения закодированы в JSON
+            try:
+                params[key] = json.loads(value)
+            except (TypeError, ValueError):
+                params[key] = value
+        return params
+
+    @staticmethod
+    def error(code, description, retry_after=None):
+        data = {'ok': False, 'error_code': code, 'description': description}
+        if retry_after is not None:
+            data['parameters'] = {'retry_after': retry_after}
+        return web.json_response(data, status=code)
+
+    def rate_limited(self, chat_id):
+        """Лимит на все сообщения за последнюю секунду и интервал на канал"""
+        now = time.monotonic()
+        while self.recent and now - self.recent[0] >= 1.0:
+            self.recent.popleft()
+        if self.rate and len(self.recent) >= self.rate:
+            return True
+        if self.chat_interval and now - self.chat_last.get(chat_id, -self.chat_interval) < self.chat_interval:
+            return True
+        self.recent.append(now)
+        self.chat_last[chat_id] = now
+        return False
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        self.requests[method] += 1
+        params = await self.read_params(request)
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+
+        if method == 'getMe':
+            return web.json_response({'ok': True, 'result': {
+                'id': 1, 'is_bot': True, 'first_name': 'Fake Garden Bot', 'username': 'fake_garden_bot'
+            }})
+        if method == 'getUpdates':
+            # Long polling: новых апдейтов не бывает
+            await asyncio.sleep(min(float(params.get('timeout', 0) or 0), 1.0))
+            return web.json_response({'ok': True, 'result': []})
+        if method not in ('sendMessage', 'editMessageText', 'pinChatMessage'):
+            return web.json_response({'ok': True, 'result': True})
+
+        chat_id = str(params.get('chat_id'))
+        if chat_id in self.missing_chats:
+            self.errors += 1
+            return self.error(400, 'Bad Request: chat not found')
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return self.error(502, 'Bad Gateway')
+        if method != 'pinChatMessage' and self.rate_limited(chat_id):
+            self.limited += 1
+            return self.error(429, f"Too Many Requests: retry after {self.retry_after}", self.retry_after)
+
+        if method == 'pinChatMessage':
+            return web.json_response({'ok': True, 'result': True})
+
+        text = params.get('text', '')
+        if method == 'editMessageText':
+            key = (chat_id, int(params.get('message_id', 0)))
+            if key not in self.messages:
+                return self.error(400, 'Bad Request: message to edit not found')
+            if self.messages[key] == text:
+                return self.error(400, 'Bad Request: message is not modified')
+            message_id = key[1]
+        else:
+            message_id = next(self.message_ids)
+        self.messages[(chat_id, message_id)] = text
+        self.per_chat[chat_id] += 1
+        if self.on_delivery:
+            self.on_delivery(method, chat_id, text, time.time())
+        return web.json_response({'ok': True, 'result': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id) if chat_id.lstrip('-').isdigit() else 0, 'type': 'channel'},
+            'text': text
+        }})
+
+    def stats(self):
+        return {
+            'uptime': round(time.time() - self.started, 1),
+            'requests': dict(self.requests),
+            'rate_limited': self.limited,
+            'errors': self.errors,
+            'chats': len(self.per_chat),
+            'messages': sum(self.per_chat.values())
+        }
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats())
+
+def main():
+    parser = argparse.ArgumentParser(description='Локальный фейковый Telegram Bot API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0, help='задержка ответа, мс')
+    parser.add_argument('--jitter', type=float, default=0, help='разброс задержки, мс')
+    parser.add_argument('--rate', type=int, default=30, help='сообщений в секунду до 429 (0 - без лимита)')
+    parser.add_argument('--chat-interval', type=float, default=0, help='мин. интервал между сообщениями в канал, сек.')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after в ответе 429, сек.')
+    parser.add_argument('--error-rate', type=float, default=0, help='доля ответов 502')
+    parser.add_argument('--missing-chat', action='append', default=[], help='канал, которого "нет" (можно несколько)')
+    args = parser.parse_args()
+
+    server = FakeTelegram(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        rate=args.rate,
+        chat_interval=args.chat_interval,
+        retry_after=args.retry_after,
+        error_rate=args.error_rate,
+        missing_chats=args.missing_chat
+    )
+    print(f"🧪 Фейковый Bot API: http://{args.host}:{args.port}/bot, статистика: /stats")
+    try:
+        web.run_app(server.app(), host=args.host, port=args.port, print=None)
+    finally:
+        print(json.dumps(server.stats(), ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+Garden Stock Bot - нагрузочный тест
+Запускает настоящий цикл опроса (check_stock_loop), рассылку и команды
+против локальных фейковых серверов: API стока (записанные ответы, задержка,
+ошибки, меняющиеся таймеры рестока) и Bot API из fake_telegram.py (лимит
+сообщений с 429 и retry_after). Печатает задержку обнаружение -> доставка,
+пропускную способность рассылки, время и CPU/память на один опрос.
+
+Фейковые серверы работают в отдельном потоке со своим event loop, поэтому
+их работа не попадает в CPU потока бота. Состояние бота (журнал, история,
+база) пишется во временный каталог.
+
+Использование:
+    python loadtest.py                                   # 1000 каналов, 60 сек.
+    python loadtest.py --channels 5000 --shards 4 --send-rate 100 --tg-rate 100
+    python loadtest.py --payload snapshot.json.gz --api-latency 800 --api-errors 0.1
+    python loadtest.py --boards 200 --coalesce 3 --trace-memory
+"""
+
+import argparse
+import asyncio
+import bisect
+import collections
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from aiohttp import web
+
+from bench_parse import REPO_DIR, read_payload, synthetic_payload
+from fake_telegram import FakeTelegram
+
+LOAD_TOKEN = '123456:LOADTEST'
+FIRST_CHANNEL_ID = -1001000000000
+
+def load_main():
+    """Импортирует main.py во временном каталоге и остается в нем до конца теста"""
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(tempfile.mkdtemp(prefix='garden-loadtest-'))
+    import main
+    return main
+
+class FakeStockApi:
+    """Фейковый growagarden.gg/api/stock
+
+    Каждые period сек. начинается новое поколение стока: берется следующий
+    записанный ответ, часть предметов пропадает, количества меняются, а
+    restockTimers указывают на конец поколения. Поддерживает ETag/304,
+    задержку ответа и долю ответов 503.
+    """
+
+    def __init__(self, payloads, categories, period=10.0, latency=0.0, jitter=0.0, error_rate=0.0, seed=1):
+        self.payloads = payloads
+        self.categories = categories
+        self.period = period
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.started = time.time()
+        self.current = None
+        self.served_generation = None
+        self.responses = collections.Counter()
+        self.runner = None
+
+    def generation(self, now=None):
+        now = time.time() if now is None else now
+        return int((now - self.started) // self.period)
+
+    def published_at(self, generation):
+        return self.started + generation * self.period
+
+    def body(self, generation):
+        """Тело ответа и ETag поколения (строится один раз)"""
+        if self.current is None or self.current[0] != generation:
+            rnd = random.Random(f"{self.seed}:{generation}")
+            data = json.loads(self.payloads[generation % len(self.payloads)])
+            for category in self.categories:
+                items = data.get(category)
+                if isinstance(items, list) and items:
+                    items = rnd.sample(items, max(1, len(items) * 2 // 3))
+                    for item in items:
+                        item['value'] = rnd.randint(1, 20)
+                    data[category] = items
+            deadline = int(self.published_at(generation + 1) * 1000)
+            data['restockTimers'] = {key: deadline for key in (data.get('restockTimers') or ('seeds', 'gears', 'eggs'))}
+            self.current = (generation, f'"stock-{generation}"', json.dumps(data).encode('utf-8'))
+        return self.current[1], self.current[2]
+
+    async def handle(self, request):
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.responses[503] += 1
+            return web.Response(status=503, text='Service Unavailable')
+        generation = self.generation()
+        etag, body = self.body(generation)
+        self.served_generation = generation
+        if request.headers.get('If-None-Match') == etag:
+            self.responses[304] += 1
+            return web.Response(status=304, headers={'ETag': etag})
+        self.responses[200] += 1
+        return web.Response(body=body, content_type='application/json', headers={'ETag': etag})
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_get('/api/stock', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}/api/stock"
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+class FakeServers:
+    """Фейковые API стока и Bot API в отдельном потоке со своим event loop"""
+
+    def __init__(self, stock_api, telegram):
+        self.stock_api = stock_api
+        self.telegram = telegram
+        self.loop = None
+        self.thread = None
+        self.clock = None
+        self.stock_url = None
+        self.telegram_url = None
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.stock_url = self.loop.run_until_complete(self.stock_api.start())
+            self.telegram_url = self.loop.run_until_complete(self.telegram.start(port=0))
+            self.clock = time.pthread_getcpuclockid(threading.get_ident())
+            ready.set()
+            self.loop.run_forever()
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run, name='fake-servers', daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def cpu_time(self):
+        return time.clock_gettime(self.clock)
+
+    def stop(self):
+        async def shutdown():
+            await self.stock_api.stop()
+            await self.telegram.stop()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+class LoadRun:
+    """Измерения одного прогона"""
+
+    def __init__(self):
+        self.detections = []        # время обнаружения изменений (epoch)
+        self.publish_to_detect = []
+        self.detect_to_deliver = []
+        self.sent_at = []           # время приема сообщений фейковым Telegram
+        self.polls = []             # (мс, CPU мс, пик памяти КиБ или None, изменился ли сток)
+        self.commands = collections.defaultdict(list)
+
+    def detected(self, at, published_at):
+        if self.detections and published_at is not None:
+            # Первое обнаружение - исходный сток, а не изменение
+            self.publish_to_detect.append(at - published_at)
+        self.detections.append(at)
+
+    def delivered(self, created_at, at):
+        """Задержка от обнаружения, после которого сообщение поставлено в очередь"""
+        index = bisect.bisect_right(self.detections, created_at) - 1
+        if index >= 0:
+            self.detect_to_deliver.append(at - self.detections[index])
+
+def instrument(bot_main, bot, api, run, trace_memory):
+    """Подключает замеры к diff, poll_stock и колбэку доставки"""
+    diff = bot.diff_engine.diff
+
+    def timed_diff(*args, **kwargs):
+        events = diff(*args, **kwargs)
+        if any(event.kind in bot_main.NOTIFY_EVENTS for event in events):
+            generation = api.served_generation
+            run.detected(time.time(), api.published_at(generation) if generation is not None else None)
+        return events
+
+    bot.diff_engine.diff = timed_diff
+
+    poll = bot.poll_stock
+
+    async def measured_poll(application):
+        if trace_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started, cpu = time.perf_counter(), time.thread_time()
+        changed = await poll(application)
+        elapsed = (time.perf_counter() - started) * 1000
+        cpu = (time.thread_time() - cpu) * 1000
+        peak = (tracemalloc.get_traced_memory()[1] - baseline) / 1024 if trace_memory else None
+        run.polls.append((elapsed, cpu, peak, changed))
+        return changed
+
+    bot.poll_stock = measured_poll
+
+    def on_delivered(chat_id, message_id, job):
+        run.delivered(job['created'], time.time())
+        bot.on_message_delivered(chat_id, message_id, job)
+
+    bot.broadcaster.on_delivered = on_delivered
+    bot.broadcaster.on_failed = bot.on_message_failed
+
+async def command_load(bot, run, rate):
+    """Команды администраторов во время опроса: /teststock и /stats"""
+
+    async def teststock():
+        started = time.perf_counter()
+        await bot.get_real_garden_stock()
+        run.commands['/teststock'].append((time.perf_counter() - started) * 1000)
+
+    tasks = set()
+    while True:
+        task = asyncio.create_task(teststock())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        started = time.perf_counter()
+        bot.get_bot_stats()
+        run.commands['/stats'].append((time.perf_counter() - started) * 1000)
+        await asyncio.sleep(1 / rate)
+
+def setup_channels(bot, channels, boards):
+    for index in range(channels):
+        bot.add_approved_channel(FIRST_CHANNEL_ID - index, f"Load channel {index}", 0)
+    for index in range(boards):
+        bot.set_channel_board(FIRST_CHANNEL_ID - index, True)
+
+async def run_load(bot_main, args, run, api, servers):
+    from telegram.ext import Application
+
+    bot = bot_main.bot
+    bot_main.STOCK_API_URL = servers.stock_url
+    bot.check_interval = args.interval
+    bot.coalescer.window = args.coalesce
+    if args.shards:
+        bot.broadcaster = bot_main.ShardedBroadcaster(bot.writer, shards=args.shards, global_rate=args.send_rate)
+    else:
+        bot.broadcaster = bot_main.Broadcaster(bot.writer, global_rate=args.send_rate)
+    instrument(bot_main, bot, api, run, args.trace_memory)
+    setup_channels(bot, args.channels, args.boards)
+
+    application = Application.builder().token(LOAD_TOKEN).base_url(servers.telegram_url).build()
+    await application.initialize()
+    await bot.broadcaster.start(application.bot)
+
+    tasks = [asyncio.create_task(bot.check_stock_loop(application))]
+    if args.command_rate:
+        tasks.append(asyncio.create_task(command_load(bot, run, args.command_rate)))
+    await asyncio.sleep(args.duration)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await bot.coalescer.close()
+    await bot.boards.close()
+
+    # Даем дослать то, что уже в очереди
+    deadline = time.monotonic() + args.drain
+    while bot.broadcaster.outbox.pending and time.monotonic() < deadline:
+        await asyncio.sleep(0.2)
+    undelivered = len(bot.broadcaster.outbox.pending)
+
+    await bot.broadcaster.stop()
+    await application.shutdown()
+    await bot.http.close()
+    await bot.writer.drain()
+    return undelivered
+
+def print_report(bot_main, args, run, api, telegram, cpu, undelivered, rss):
+    p = bot_main.percentile
+
+    def ms_row(name, values, unit='мс'):
+        if not values:
+            return f"{name:<34}нет данных"
+        return (f"{name:<34}p50 {p(values, 0.5):>8.1f}  p95 {p(values, 0.95):>8.1f}  "
+                f"p99 {p(values, 0.99):>8.1f}  max {max(values):>8.1f} {unit}  (n={len(values)})")
+
+    print(f"\n📦 API стока: рестокинг каждые {args.period:g} сек., задержка {args.api_latency:g}±{args.api_jitter:g} мс, "
+          f"ошибки {args.api_errors:.0%}, ответы {dict(api.responses)}")
+    limit = f"{args.tg_rate}/сек." if args.tg_rate else "без лимита"
+    print(f"📨 Telegram: лимит {limit}, retry_after {args.retry_after} сек., задержка {args.tg_latency:g} мс; "
+          f"каналов {args.channels} (табло {args.boards}), процессов доставки {args.shards or 'нет'}")
+
+    changed = [poll for poll in run.polls if poll[3]]
+    print(f"\n🔁 Опросов: {len(run.polls)}, с изменениями: {len(changed)}")
+    print(ms_row("время опроса (все)", [poll[0] for poll in run.polls]))
+    print(ms_row("время опроса (с изменениями)", [poll[0] for poll in changed]))
+    print(ms_row("CPU потока бота на опрос", [poll[1] for poll in run.polls]))
+    if args.trace_memory:
+        print(ms_row("пик выделенной памяти на опрос", [poll[2] for poll in run.polls], 'КиБ'))
+    print(f"{'RSS процесса':<34}{rss[0] / 1024:.1f} -> {rss[1] / 1024:.1f} МиБ (пик)")
+
+    print("\n⏱ Задержки")
+    print(ms_row("рестокинг -> обнаружение", [value * 1000 for value in run.publish_to_detect]))
+    print(ms_row("обнаружение -> доставка", [value * 1000 for value in run.detect_to_deliver]))
+
+    sent = sorted(run.sent_at)
+    span = sent[-1] - sent[0] if len(sent) > 1 else 0
+    rate = len(sent) / span if span else 0
+    print(f"\n📮 Сообщений принято Telegram: {len(sent)} ({rate:.1f}/сек.), недоставлено к концу: {undelivered}")
+    print(f"   ответов 429: {telegram.limited}, ошибок: {telegram.errors}, запросы: {dict(telegram.requests)}")
+
+    if run.commands:
+        print("\n💬 Команды")
+        for name, values in sorted(run.commands.items()):
+            print(ms_row(name, values))
+
+    bot_cpu, children_cpu, fake_cpu = cpu
+    print(f"\n🧮 CPU за {args.duration:g} сек.: бот {bot_cpu:.2f} с ({bot_cpu / args.duration:.1%} ядра), "
+          f"процессы доставки {children_cpu:.2f} с, фейковые серверы {fake_cpu:.2f} с")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест опроса, рассылки и команд')
+    parser.add_argument('--payload', action='append', default=[], help='записанный ответ API (.json/.json.gz), можно несколько')
+    parser.add_argument('--duration', type=float, default=60, help='длительность, сек.')
+    parser.add_argument('--drain', type=float, default=30, help='сколько ждать досылки после остановки опроса, сек.')
+    parser.add_argument('--channels', type=int, default=1000)
+    parser.add_argument('--boards', type=int, default=0, help='сколько каналов в режиме живого табло')
+    parser.add_argument('--shards', type=int, default=0, help='процессов доставки (0 - в процессе бота)')
+    parser.add_argument('--interval', type=float, default=5, help='check_interval бота, сек.')
+    parser.add_argument('--coalesce', type=float, default=0, help='окно объединения событий, сек.')
+    parser.add_argument('--send-rate', type=int, default=30, help='лимит отправок бота в секунду')
+    parser.add_argument('--period', type=float, default=15, help='период рестока фейкового API, сек.')
+    parser.add_argument('--api-latency', type=float, default=100, help='задержка API стока, мс')
+    parser.add_argument('--api-jitter', type=float, default=50, help='разброс задержки API стока, мс')
+    parser.add_argument('--api-errors', type=float, default=0, help='доля ответов 503 API стока')
+    parser.add_argument('--tg-rate', type=int, default=30, help='лимит фейкового Telegram, сообщений в секунду')
+    parser.add_argument('--tg-latency', type=float, default=30, help='задержка фейкового Telegram, мс')
+    parser.add_argument('--tg-errors', type=float, default=0, help='доля ответов 502 фейкового Telegram')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after в ответах 429, сек.')
+    parser.add_argument('--command-rate', type=float, default=2, help='команд в секунду (0 - без команд)')
+    parser.add_argument('--trace-memory', action='store_true', help='пик памяти на опрос через tracemalloc (медленнее)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='не скрывать логи бота')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    payloads = [read_payload(path) for path in args.payload]
+
+    bot_main = load_main()
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    if not payloads:
+        payloads = [synthetic_payload(bot_main, seed) for seed in range(1, 4)]
+
+    api = FakeStockApi(
+        payloads, bot_main.STOCK_CATEGORIES,
+        period=args.period,
+        latency=args.api_latency / 1000,
+        jitter=args.api_jitter / 1000,
+        error_rate=args.api_errors
+    )
+    telegram = FakeTelegram(
+        latency=args.tg_latency / 1000,
+        rate=args.tg_rate,
+        retry_after=args.retry_after,
+        error_rate=args.tg_errors
+    )
+    run = LoadRun()
+    telegram.on_delivery = lambda method, chat_id, text, at: run.sent_at.append(at)
+    servers = FakeServers(api, telegram)
+    servers.start()
+    print(f"🧪 Каталог состояния: {os.getcwd()}, длительность {args.duration:g} сек.")
+
+    if args.trace_memory:
+        tracemalloc.start()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    process_cpu, fake_cpu = time.process_time(), servers.cpu_time()
+    undelivered = asyncio.run(run_load(bot_main, args, run, api, servers))
+    fake_cpu = servers.cpu_time() - fake_cpu
+    bot_cpu = time.process_time() - process_cpu - fake_cpu
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    servers.stop()
+
+    print_report(bot_main, args, run, api, telegram, (bot_cpu, children.ru_utime + children.ru_stime, fake_cpu),
+                 undelivered, (rss_before, rss_after))
+
+if __name__ == '__main__':
+    main()
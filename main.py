@@ -1,15 +1,49 @@
 import asyncio
 import aiohttp
+import collections
+import gzip
+import hashlib
+import itertools
 import json
 import time
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta, timezone
 import logging
+import multiprocessing
 import os
+import random
+import re
+import sqlite3
+import struct
+import sys
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
-from flask import Flask
+from flask import Flask, jsonify
+from broadcast_worker import ConsistentHashRing, SharedTokenBucket, run_worker
 from threading import Thread
 
+# Быстрые JSON библиотеки необязательны: без них работает стандартный json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# NumPy нужен только для аналитики истории (/forecast)
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -21,38 +55,2521 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Файлы для хранения данных
-WHITELIST_FILE = 'whitelist.json'
-APPROVED_CHANNELS_FILE = 'approved_channels.json'
-STATS_FILE = 'stats.json'
-PENDING_CHANNELS_FILE = 'pending_channels.json'
-PROCTOR_FILE = 'proctor.json'
+# Файлы для хранения данных
+WHITELIST_FILE = 'whitelist.json'
+APPROVED_CHANNELS_FILE = 'approved_channels.json'
+STATS_FILE = 'stats.json'
+PENDING_CHANNELS_FILE = 'pending_channels.json'
+PROCTOR_FILE = 'proctor.json'
+OUTBOX_FILE = 'outbox.jsonl'
+STATE_DB_FILE = 'bot_state.db'
+DEBUG_CAPTURE_DIR = 'debug_snapshots'
+HISTORY_DIR = 'history'
+
+# Типичные периоды рестока (сек.), пока период не виден по таймерам API
+DEFAULT_RESTOCK_PERIODS = {
+    'seedsStock': 300,
+    'gearStock': 300,
+    'eggStock': 1800,
+    'honeyStock': 3600,
+    'nightStock': 3600,
+    'easterStock': 3600,
+    'cosmeticsStock': 14400
+}
+
+# Версия формата сохраненного снимка стока (в bot_state.db, ns 'stock')
+STOCK_SNAPSHOT_VERSION = 1
+
+# Сколько команда чтения ждет живой запрос к API, если снимка в кэше нет (сек.)
+STOCK_READ_TIMEOUT = 3.0
+
+# Источник данных о стоке
+STOCK_API_URL = 'https://growagarden.gg/api/stock'
+STOCK_API_HEADERS = {
+    'accept': '*/*',
+    'accept-language': 'en-US,en;q=0.9',
+    'content-type': 'application/json',
+    'priority': 'u=1, i',
+    'referer': 'https://growagarden.gg/stocks',
+    'trpc-accept': 'application/json',
+    'x-trpc-source': 'gag',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+}
+
+# Категории стока в ответе API
+STOCK_CATEGORIES = (
+    'easterStock',      # Пасхальный сток
+    'gearStock',        # Инструменты
+    'eggStock',         # Яйца
+    'nightStock',       # Ночной магазин
+    'honeyStock',       # Мед
+    'cosmeticsStock',   # Косметика
+    'seedsStock'        # Семена
+)
+
+# Группы равнозначных написаний предметов (в API и в списке отслеживания)
+ITEM_ALIASES = [
+    ('grandmaster sprinkler', 'grantmaster sprinkler'),
+]
+
+# Ошибки, после которых канал удаляется из одобренных
+PERMANENT_SEND_ERRORS = ["Chat not found", "bot is not a member", "Forbidden", "unauthorized"]
+
+# Веб-сервер для Replit
+app = Flask('')
+
+@app.route('/')
+def home():
+    return "🌿 Garden Stock Bot is running!"
+
+@app.route('/health')
+def health():
+    status = bot.poller.health()
+    _, age = bot.cached_stock()
+    status['stock_age'] = round(age, 1) if age is not None else None
+    return jsonify(status), (503 if status['state'] == PollerSupervisor.CIRCUIT_OPEN else 200)
+
+def run_web():
+    app.run(host='0.0.0.0', port=8080)
+
+def write_json_file(filename, data, indent=2):
+    """Атомарно записывает JSON файл через временный файл"""
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+    os.replace(tmp_filename, filename)
+
+class AsyncWriter:
+    """Фоновый писатель: вся запись на диск идет в одном отдельном потоке
+
+    Задачи выполняются строго по порядку. Задача с ключом, который уже ждет
+    в очереди, заменяет ожидающую (последняя версия данных выигрывает),
+    поэтому частые сохранения одного файла объединяются в одну запись.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='disk-writer')
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.written = 0
+        self.coalesced = 0
+
+    def submit(self, key, fn, *args):
+        """Ставит запись в очередь без ожидания"""
+        with self.lock:
+            if key in self.pending:
+                self.pending[key] = (fn, args)
+                self.coalesced += 1
+                return
+            self.pending[key] = (fn, args)
+        self.executor.submit(self._run, key)
+
+    def _run(self, key):
+        with self.lock:
+            fn, args = self.pending.pop(key)
+        try:
+            fn(*args)
+            self.written += 1
+        except Exception as e:
+            logger.error(f"❌ Ошибка фоновой записи ({key}): {e}")
+
+    async def run(self, fn, *args):
+        """Выполняет запись в потоке писателя и дожидается ее (без объединения)"""
+        result = await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        self.written += 1
+        return result
+
+    async def drain(self):
+        """Дожидается выполнения всех поставленных ранее записей"""
+        await asyncio.get_running_loop().run_in_executor(self.executor, lambda: None)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def format_metrics(self):
+        return f"💾 Фоновых записей на диск: {self.written} (объединено: {self.coalesced})"
+
+class DebugCapture:
+    """Выборочное сохранение ответов API на диск для разбора проблем
+
+    Режимы: off - выключено, every - каждая N-я проверка, change - только
+    изменившиеся ответы, error - только ответы, которые не удалось разобрать.
+    Ошибки разбора сохраняются в любом режиме, кроме off. Хранится только
+    ring_size последних снимков; старые удаляются.
+    """
+
+    MODES = ('off', 'every', 'change', 'error')
+
+    def __init__(self, writer, directory=DEBUG_CAPTURE_DIR, mode='off', every=10, ring_size=20, compress=True):
+        self.writer = writer
+        self.directory = directory
+        self.mode = mode if mode in self.MODES else 'off'
+        self.every = max(1, int(every))
+        self.ring_size = max(1, int(ring_size))
+        self.compress = bool(compress)
+        self.polls = 0
+        self.captured = 0
+        self.last_body = None
+        self._seq = itertools.count()
+        self.files = collections.deque(self._existing_files())
+
+    @classmethod
+    def from_settings(cls, writer, settings):
+        """Создает объект по настройкам из proctor.json"""
+        settings = settings if isinstance(settings, dict) else {}
+        return cls(
+            writer,
+            mode=settings.get('mode', 'off'),
+            every=settings.get('every', 10),
+            ring_size=settings.get('ring_size', 20),
+            compress=settings.get('compress', True)
+        )
+
+    def settings(self):
+        return {
+            'mode': self.mode,
+            'every': self.every,
+            'ring_size': self.ring_size,
+            'compress': self.compress
+        }
+
+    def _existing_files(self):
+        try:
+            return sorted(
+                os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.startswith('stock-')
+            )
+        except FileNotFoundError:
+            return []
+
+    def observe(self, body, changed=False, error=False):
+        """Учитывает опрос API и сохраняет ответ, если так велит режим
+
+        Вызывается на каждый опрос, чтобы выборка every не сбивалась.
+        body=None - запрос не удался и сохранять нечего.
+        """
+        if self.mode == 'off':
+            return
+        self.polls += 1
+        if body is None:
+            return
+        self.last_body = body
+        if error:
+            reason = 'error'
+        elif self.mode == 'every' and self.polls % self.every == 0:
+            reason = 'sample'
+        elif self.mode == 'change' and changed:
+            reason = 'change'
+        else:
+            return
+        self.capture(body, reason)
+
+    def capture(self, body, reason):
+        """Ставит снимок в очередь записи; имя файла сортируется по времени"""
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        filename = os.path.join(self.directory, f"stock-{stamp}-{next(self._seq):06d}-{reason}.json")
+        if self.compress:
+            filename += '.gz'
+        self.files.append(filename)
+        expired = []
+        while len(self.files) > self.ring_size:
+            expired.append(self.files.popleft())
+        self.captured += 1
+        self.writer.submit(filename, self._write, filename, bytes(body), expired)
+
+    def _write(self, filename, body, expired):
+        os.makedirs(self.directory, exist_ok=True)
+        if self.compress:
+            with gzip.open(filename, 'wb', compresslevel=6) as f:
+                f.write(body)
+        else:
+            with open(filename, 'wb') as f:
+                f.write(body)
+        for old_filename in expired:
+            try:
+                os.remove(old_filename)
+            except FileNotFoundError:
+                pass
+
+    def describe(self):
+        if self.mode == 'off':
+            return "🐞 Отладочные снимки: выключены"
+        mode = f"каждая {self.every}-я проверка" if self.mode == 'every' else self.mode
+        return f"🐞 Отладочные снимки: {mode}, сохранено {self.captured}, хранится до {self.ring_size}"
+
+class StockHttpClient:
+    """Долгоживущий HTTP клиент с пулом keep-alive соединений и метриками времени"""
+
+    def __init__(self, headers=None, timeout=15, pool_size=4, dns_ttl=300, keepalive=60):
+        self.headers = dict(headers or {})
+        self.headers.setdefault('accept-encoding', self.supported_encodings())
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.pool_size = pool_size
+        self.dns_ttl = dns_ttl
+        self.keepalive = keepalive
+        self.session = None
+        self.metrics = {
+            'requests': 0,
+            'errors': 0,
+            'new_connections': 0,
+            'reused_connections': 0,
+            'connect_ms_total': 0.0,
+            'ttfb_ms_total': 0.0,
+            'body_ms_total': 0.0,
+            'last': None
+        }
+
+    @staticmethod
+    def supported_encodings():
+        """Возвращает список поддерживаемых алгоритмов сжатия"""
+        encodings = 'gzip, deflate'
+        try:
+            import brotli  # noqa: F401
+            encodings += ', br'
+        except ImportError:
+            pass
+        return encodings
+
+    def _trace_config(self):
+        """Создает трассировку для замера connect / TTFB"""
+        trace = aiohttp.TraceConfig()
+
+        # Замеры пишутся в словарь, переданный через trace_request_ctx
+        async def on_request_start(session, ctx, params):
+            ctx.trace_request_ctx['start'] = asyncio.get_running_loop().time()
+
+        async def on_connection_create_start(session, ctx, params):
+            ctx.trace_request_ctx['connect_start'] = asyncio.get_running_loop().time()
+
+        async def on_connection_create_end(session, ctx, params):
+            timing = ctx.trace_request_ctx
+            timing['connect'] = asyncio.get_running_loop().time() - timing['connect_start']
+
+        async def on_connection_reuseconn(session, ctx, params):
+            ctx.trace_request_ctx['reused'] = True
+
+        async def on_request_end(session, ctx, params):
+            ctx.trace_request_ctx['headers_at'] = asyncio.get_running_loop().time()
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_connection_create_start.append(on_connection_create_start)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace.on_request_end.append(on_request_end)
+        return trace
+
+    def _get_session(self):
+        """Лениво создает сессию внутри работающего event loop"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                ttl_dns_cache=self.dns_ttl,
+                use_dns_cache=True,
+                keepalive_timeout=self.keepalive
+            )
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                timeout=self.timeout,
+                connector=connector,
+                trace_configs=[self._trace_config()]
+            )
+            logger.info("🔌 Создана HTTP сессия с пулом соединений")
+        return self.session
+
+    async def get(self, url, headers=None):
+        """Выполняет GET запрос и возвращает (status, headers, body)"""
+        session = self._get_session()
+        timing = {}
+        try:
+            async with session.get(url, headers=headers, trace_request_ctx=timing) as response:
+                body = await response.read()
+                timing['body_at'] = asyncio.get_running_loop().time()
+                self._record(timing)
+                return response.status, response.headers, body
+        except Exception:
+            self.metrics['errors'] += 1
+            raise
+
+    def _record(self, timing):
+        """Сохраняет метрики времени запроса"""
+        if 'start' not in timing:
+            return
+
+        headers_at = timing.get('headers_at', timing['body_at'])
+        connect_ms = timing.get('connect', 0.0) * 1000
+        ttfb_ms = (headers_at - timing['start']) * 1000
+        body_ms = (timing['body_at'] - headers_at) * 1000
+
+        self.metrics['requests'] += 1
+        if timing.get('reused'):
+            self.metrics['reused_connections'] += 1
+        else:
+            self.metrics['new_connections'] += 1
+        self.metrics['connect_ms_total'] += connect_ms
+        self.metrics['ttfb_ms_total'] += ttfb_ms
+        self.metrics['body_ms_total'] += body_ms
+        self.metrics['last'] = {
+            'connect_ms': round(connect_ms, 1),
+            'ttfb_ms': round(ttfb_ms, 1),
+            'body_ms': round(body_ms, 1)
+        }
+
+    def format_metrics(self):
+        """Форматирует метрики HTTP для /stats"""
+        m = self.metrics
+        if not m['requests']:
+            return "🌐 HTTP: запросов еще не было"
+        n = m['requests']
+        last = m['last'] or {}
+        return (
+            f"🌐 HTTP запросов: {n} (ошибок: {m['errors']}, новых соединений: {m['new_connections']}, "
+            f"повторно использовано: {m['reused_connections']})\n"
+            f"⏱ Среднее: connect {m['connect_ms_total'] / n:.0f} мс, "
+            f"TTFB {m['ttfb_ms_total'] / n:.0f} мс, тело {m['body_ms_total'] / n:.0f} мс\n"
+            f"⏱ Последний: connect {last.get('connect_ms', 0):.0f} мс, "
+            f"TTFB {last.get('ttfb_ms', 0):.0f} мс, тело {last.get('body_ms', 0):.0f} мс"
+        )
+
+    async def close(self):
+        """Закрывает сессию и пул соединений"""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+            logger.info("🔌 HTTP сессия закрыта")
+        self.session = None
+
+class RestockScheduler:
+    """Планировщик опроса по таймерам рестока из restockTimers
+
+    Вне окна рестока спит до момента незадолго до ближайшего рестока
+    (и увеличивает паузу, пока ничего не меняется), а вокруг границы
+    рестока опрашивает API с коротким интервалом.
+    """
+
+    def __init__(self, lead=3.0, burst_interval=1.0, burst_window=20.0, max_idle=300, backoff=1.5):
+        self.lead = lead                      # за сколько секунд до рестока начинать частый опрос
+        self.burst_interval = burst_interval  # интервал частого опроса
+        self.burst_window = burst_window      # сколько секунд после рестока ждать изменений
+        self.max_idle = max_idle
+        self.backoff = backoff
+        self.deadlines = {}       # дедлайны с незакрытым окном - для частого опроса
+        self.last_deadline = {}   # последний известный дедлайн - для обнаружения рестоков
+        self.periods = {}
+        self.restocked = set()
+        self.idle_delay = None
+        self.mode = 'idle'
+
+    @staticmethod
+    def parse_timer(value, now):
+        """Переводит значение таймера в абсолютное время (сек. epoch)
+
+        Поддерживаются абсолютные метки в мс и сек., а также
+        оставшееся время в мс.
+        """
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return None
+        if value <= 0:
+            return None
+        if value > 1e12:
+            return value / 1000
+        if value > 1e9:
+            return value
+        return now + value / 1000
+
+    def update_timers(self, timers, now=None):
+        """Обновляет дедлайны рестоков по данным API"""
+        if not isinstance(timers, dict):
+            return
+        now = time.time() if now is None else now
+        for category, value in timers.items():
+            deadline = self.parse_timer(value, now)
+            if deadline is None:
+                continue
+            previous = self.last_deadline.get(category)
+            if previous is not None and previous <= now < deadline:
+                # Таймер перешел на следующий цикл - рестокинг состоялся
+                self.restocked.add(category)
+                # Разница дедлайнов - период рестока (после простоя кратна ему,
+                # поэтому берем минимальную)
+                period = round(deadline - previous)
+                if period > 0:
+                    self.periods[category] = min(period, self.periods.get(category, period))
+            self.deadlines[category] = deadline
+            self.last_deadline[category] = deadline
+
+    def pop_restocked(self):
+        """Таймеры, прошедшие с прошлого вызова (ключи restockTimers)"""
+        restocked, self.restocked = self.restocked, set()
+        return restocked
+
+    def next_restock(self, now=None):
+        """Ближайший рестокинг, окно которого еще не закрыто: (категория, время)"""
+        now = time.time() if now is None else now
+        upcoming = [(deadline, category) for category, deadline in self.deadlines.items()
+                    if deadline + self.burst_window > now]
+        if not upcoming:
+            return None, None
+        deadline, category = min(upcoming)
+        return category, deadline
+
+    def next_delay(self, base_interval, changed, now=None):
+        """Возвращает паузу до следующего опроса в секундах"""
+        now = time.time() if now is None else now
+
+        # Закрытые окна больше не интересны
+        for category, deadline in list(self.deadlines.items()):
+            if deadline + self.burst_window <= now:
+                del self.deadlines[category]
+
+        if changed or self.idle_delay is None:
+            self.idle_delay = base_interval
+        else:
+            self.idle_delay = min(self.idle_delay * self.backoff, max(self.max_idle, base_interval))
+
+        category, deadline = self.next_restock(now)
+        if deadline is not None and now >= deadline - self.lead:
+            if changed and now >= deadline:
+                # Рестокинг уже пришел, частый опрос больше не нужен
+                del self.deadlines[category]
+                category, deadline = self.next_restock(now)
+            else:
+                self.mode = 'burst'
+                return self.burst_interval
+
+        self.mode = 'idle'
+        if deadline is None:
+            # Без таймеров не знаем, когда ждать изменений - опрашиваем с базовым интервалом
+            return base_interval
+        delay = min(self.idle_delay, deadline - self.lead - now)
+        return max(delay, self.burst_interval)
+
+    def describe(self, now=None):
+        """Текстовое описание состояния для /stats"""
+        now = time.time() if now is None else now
+        category, deadline = self.next_restock(now)
+        mode = "частый опрос" if self.mode == 'burst' else "ожидание"
+        if deadline is None:
+            return f"🗓 Планировщик: {mode}, таймеры рестока неизвестны"
+        return f"🗓 Планировщик: {mode}, следующий рестокинг ({category}) через {max(0, int(deadline - now))} сек."
+
+class PollerSupervisor:
+    """Состояние опроса API, паузы после ошибок и предохранитель
+
+    healthy - опросы успешны; degraded - первые ошибки подряд, опрос идет
+    по обычному расписанию; backoff - экспоненциальная пауза с джиттером;
+    circuit-open - после open_after ошибок подряд запросы к API сразу
+    отклоняются (allow_request) около open_timeout сек., затем проходит
+    одна пробная проверка. Первый успех возвращает в healthy. История
+    переходов ограничена.
+    """
+
+    HEALTHY = 'healthy'
+    DEGRADED = 'degraded'
+    BACKOFF = 'backoff'
+    CIRCUIT_OPEN = 'circuit-open'
+
+    def __init__(self, backoff_after=3, open_after=10, base_delay=5.0, max_delay=300.0, open_timeout=600.0,
+                 history_size=20):
+        self.backoff_after = backoff_after
+        self.open_after = open_after
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.open_timeout = open_timeout
+        self.state = self.HEALTHY
+        self.state_since = time.time()
+        self.failures = 0
+        self.total_failures = 0
+        self.last_success = None
+        self.last_error = None
+        self.next_poll_at = None
+        self.retry_at = None
+        self.transitions = collections.deque(maxlen=history_size)
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        now = time.time()
+        self.transitions.append((now, self.state, state))
+        logger.log(
+            logging.INFO if state == self.HEALTHY else logging.WARNING,
+            f"🩺 Опрос API: {self.state} -> {state} (ошибок подряд: {self.failures})"
+        )
+        self.state = state
+        self.state_since = now
+
+    def record_success(self):
+        self.failures = 0
+        self.last_success = time.time()
+        self._set_state(self.HEALTHY)
+
+    def record_failure(self, error=None):
+        """Учитывает ошибку; возвращает True, если опрос только что перешел в backoff"""
+        previous = self.state
+        self.failures += 1
+        self.total_failures += 1
+        self.last_error = str(error) if error else 'нет данных'
+        if self.failures >= self.open_after:
+            self._set_state(self.CIRCUIT_OPEN)
+            # Джиттер, чтобы пробный запрос не шел строго синхронно с чужими
+            self.retry_at = time.time() + random.uniform(0.75, 1.0) * self.open_timeout
+        elif self.failures >= self.backoff_after:
+            self._set_state(self.BACKOFF)
+        else:
+            self._set_state(self.DEGRADED)
+        return self.state == self.BACKOFF and previous != self.BACKOFF
+
+    def allow_request(self, now=None):
+        """Можно ли идти в API; при открытом предохранителе пропускает одну пробу"""
+        if self.state != self.CIRCUIT_OPEN:
+            return True
+        now = time.time() if now is None else now
+        if self.retry_at is not None and now < self.retry_at:
+            return False
+        # Пока проба не закончилась, остальные запросы отклоняются
+        self.retry_at = now + self.open_timeout
+        return True
+
+    def next_delay(self, normal_delay):
+        """Пауза до следующего опроса с учетом состояния"""
+        now = time.time()
+        if self.state == self.CIRCUIT_OPEN:
+            delay = max(normal_delay, (self.retry_at or now) - now)
+        elif self.state == self.BACKOFF:
+            base = max(self.base_delay, normal_delay)
+            delay = min(self.max_delay, base * 2 ** (self.failures - self.backoff_after + 1))
+            # Джиттер, чтобы повторы не шли строго синхронно с чужими
+            delay = max(normal_delay, random.uniform(delay / 2, delay))
+        else:
+            delay = normal_delay
+        self.next_poll_at = now + delay
+        return delay
+
+    def health(self):
+        now = time.time()
+        return {
+            'state': self.state,
+            'state_for': round(now - self.state_since, 1),
+            'consecutive_failures': self.failures,
+            'total_failures': self.total_failures,
+            'last_success_age': round(now - self.last_success, 1) if self.last_success else None,
+            'last_error': self.last_error,
+            'retry_in': round(max(0.0, self.retry_at - now), 1) if self.state == self.CIRCUIT_OPEN else None,
+            'next_poll_in': round(max(0.0, self.next_poll_at - now), 1) if self.next_poll_at else None
+        }
+
+    def describe(self):
+        status = self.health()
+        icon = {self.HEALTHY: '🟢', self.DEGRADED: '🟡', self.BACKOFF: '🟠', self.CIRCUIT_OPEN: '🔴'}[self.state]
+        text = f"{icon} Опрос API: {self.state} ({status['state_for']:.0f} сек.)"
+        if self.failures:
+            text += f", ошибок подряд: {self.failures}, последняя: {self.last_error}"
+        if status['last_success_age'] is not None:
+            text += f", успешный опрос {status['last_success_age']:.0f} сек. назад"
+        return text
+
+def stock_quantity(value):
+    """Приводит количество из API к int (некорректное значение - 0)"""
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return 0
+    if isinstance(value, (int, float)):
+        return int(value)
+    return 0
+
+STOCK_PAYLOAD_KEYS = STOCK_CATEGORIES + ('restockTimers',)
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+JSON_SKIP_TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]]')
+
+def decode_json(body):
+    """Полное декодирование JSON самой быстрой доступной библиотекой"""
+    if orjson is not None:
+        return orjson.loads(body)
+    if msgspec is not None:
+        return msgspec.json.decode(body)
+    return json.loads(body)
+
+def _skip_json_value(text, position, decoder):
+    """Возвращает позицию за значением, не создавая вложенных объектов"""
+    if text[position] not in '{[':
+        return decoder.raw_decode(text, position)[1]
+    depth = 0
+    for match in JSON_SKIP_TOKEN.finditer(text, position):
+        token = match.group()
+        if token in ('{', '['):
+            depth += 1
+        elif token in ('}', ']'):
+            depth -= 1
+            if depth == 0:
+                return match.end()
+    raise ValueError("незакрытое значение в ответе")
+
+def _decode_stock_stdlib(body):
+    """Декодирует только массивы стока и таймеры, перешагивая остальное
+
+    Обходит ключи корневого объекта: значения ключей стока разбираются
+    через raw_decode, остальные (imageData, lastSeen, вложенные объекты)
+    перешагиваются без создания объектов. Одноименные ключи во вложенных
+    объектах не учитываются, как и при полном декодировании.
+    """
+    text = body.decode('utf-8') if isinstance(body, (bytes, bytearray)) else body
+    decoder = json.JSONDecoder()
+    result = {}
+    position = JSON_WHITESPACE.match(text).end()
+    if not text.startswith('{', position):
+        raise ValueError("ответ API не является JSON-объектом")
+    position = JSON_WHITESPACE.match(text, position + 1).end()
+    if text.startswith('}', position):
+        return result
+    while True:
+        key, position = decoder.raw_decode(text, position)
+        position = JSON_WHITESPACE.match(text, position).end()
+        if not isinstance(key, str) or not text.startswith(':', position):
+            raise ValueError(f"некорректный JSON на позиции {position}")
+        position = JSON_WHITESPACE.match(text, position + 1).end()
+        if key in STOCK_PAYLOAD_KEYS:
+            # Повторный ключ перекрывает прежний, как в json.loads
+            result[key], position = decoder.raw_decode(text, position)
+        else:
+            position = _skip_json_value(text, position, decoder)
+        position = JSON_WHITESPACE.match(text, position).end()
+        if text.startswith('}', position):
+            break
+        if not text.startswith(',', position):
+            raise ValueError(f"некорректный JSON на позиции {position}")
+        position = JSON_WHITESPACE.match(text, position + 1).end()
+    if not result:
+        raise ValueError("в ответе не найдено ни одной категории стока")
+    return result
+
+if msgspec is not None:
+    _StockPayload = msgspec.defstruct(
+        'StockPayload',
+        [(key, Optional[list], None) for key in STOCK_CATEGORIES] + [('restockTimers', Optional[dict], None)]
+    )
+    _stock_payload_decoder = msgspec.json.Decoder(_StockPayload)
+
+    def _decode_stock_msgspec(body):
+        """Декодирует по схеме: неизвестные поля (imageData, lastSeen) пропускаются без создания объектов"""
+        payload = _stock_payload_decoder.decode(body)
+        return {key: getattr(payload, key) for key in STOCK_PAYLOAD_KEYS if getattr(payload, key) is not None}
+
+STOCK_DECODERS = {'stdlib': _decode_stock_stdlib}
+if orjson is not None:
+    STOCK_DECODERS['orjson'] = orjson.loads
+if msgspec is not None:
+    STOCK_DECODERS['msgspec'] = _decode_stock_msgspec
+STOCK_DECODER = next(name for name in ('msgspec', 'orjson', 'stdlib') if name in STOCK_DECODERS)
+
+def decode_stock_payload(body, backend=None):
+    """Декодирует ответ API в объем, достаточный для уведомлений
+
+    Если частичный разбор не удался (неожиданный формат), используется
+    полное декодирование.
+    """
+    try:
+        return STOCK_DECODERS[backend or STOCK_DECODER](body)
+    except Exception as e:
+        logger.warning(f"⚠️ Частичный разбор ответа не удался ({e}), декодируем полностью")
+        return decode_json(body)
+
+def extract_tracked_stock(raw_data, tracked):
+    """Однопроходное извлечение {категория: {название: количество}} из сырого ответа API
+
+    Идет прямо по массивам стока без промежуточных копий предметов, не
+    трогает lastSeen и imageData и возвращает только отслеживаемые
+    предметы в наличии (под каноническими названиями из tracked).
+    Категории без отслеживаемых предметов в результат не попадают.
+    """
+    snapshot = {}
+    resolve = tracked.resolve
+    for category in STOCK_CATEGORIES:
+        items = raw_data.get(category)
+        if not isinstance(items, list):
+            continue
+        stock_items = {}
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            name = item.get('name')
+            if not name:
+                continue
+            canonical = resolve(name)
+            if canonical is None:
+                continue
+            quantity = item.get('value')
+            if quantity is None:
+                continue
+            quantity = stock_quantity(quantity)
+            if quantity > 0:
+                stock_items[canonical] = quantity
+        if stock_items:
+            snapshot[category] = stock_items
+    return snapshot
+
+def flatten_stock(snapshot):
+    """Сводит снимок по категориям в {название: количество}"""
+    stock_items = {}
+    for category in STOCK_CATEGORIES:
+        stock_items.update(snapshot.get(category, ()))
+    return stock_items
+
+# Типы событий изменения стока
+EVENT_APPEARED = 'appeared'
+EVENT_DISAPPEARED = 'disappeared'
+EVENT_QUANTITY_UP = 'quantity_up'
+EVENT_QUANTITY_DOWN = 'quantity_down'
+EVENT_RESTOCKED = 'restocked'
+
+# События, о которых сообщаем в каналы
+NOTIFY_EVENTS = frozenset({EVENT_APPEARED, EVENT_QUANTITY_UP, EVENT_RESTOCKED})
+
+StockEvent = collections.namedtuple('StockEvent', 'kind category name old new')
+
+class StockDiffEngine:
+    """Сравнивает снимки стока по категориям и выдает типизированные события
+
+    Неизменившиеся категории отсекаются одним сравнением словарей, поэтому
+    поэлементная работа идет только там, где что-то поменялось.
+    """
+
+    def __init__(self):
+        self.previous = {}
+
+    def reset(self, snapshot=None):
+        self.previous = snapshot or {}
+
+    def diff(self, current, restocked_categories=()):
+        """События между предыдущим и текущим снимком; текущий запоминается
+
+        restocked_categories - категории, у которых между снимками прошел
+        таймер рестока: оставшиеся в стоке предметы дают событие restocked.
+        """
+        events = []
+        previous = self.previous
+        for category in STOCK_CATEGORIES:
+            old_items = previous.get(category, {})
+            new_items = current.get(category, {})
+            restocked = category in restocked_categories
+            if old_items == new_items and not restocked:
+                continue
+            for name, quantity in new_items.items():
+                old_quantity = old_items.get(name)
+                if old_quantity is None:
+                    events.append(StockEvent(EVENT_APPEARED, category, name, 0, quantity))
+                elif quantity > old_quantity:
+                    events.append(StockEvent(EVENT_QUANTITY_UP, category, name, old_quantity, quantity))
+                elif quantity < old_quantity:
+                    events.append(StockEvent(EVENT_QUANTITY_DOWN, category, name, old_quantity, quantity))
+                elif restocked:
+                    events.append(StockEvent(EVENT_RESTOCKED, category, name, old_quantity, quantity))
+            for name in old_items.keys() - new_items.keys():
+                events.append(StockEvent(EVENT_DISAPPEARED, category, name, old_items[name], 0))
+        self.previous = current
+        return events
+
+def timer_category(timer_key):
+    """Категория стока для ключа из restockTimers (seeds -> seedsStock)"""
+    prefix = str(timer_key).lower()[:3]
+    for category in STOCK_CATEGORIES:
+        if category.lower().startswith(prefix):
+            return category
+    return None
+
+class StockHistory:
+    """История стока: append-only файлы по дням (history/YYYY-MM-DD.bin, UTC)
+
+    Каждый опрос - одна запись. Предметы хранятся номерами из словаря
+    items.json, номера, категории и количества - колонками array. Если сток
+    не изменился с прошлой записи, пишется только маркер повтора (5 байт),
+    поэтому месяцы опросов раз в 30 сек. занимают единицы МБ.
+
+    Формат записи (little-endian): тип (B) и время (I, сек. epoch). У снимка
+    дальше число предметов n (H) и колонки: номера n*H, категории n*B
+    (индекс в STOCK_CATEGORIES), количества n*H.
+    """
+
+    RECORD_SNAPSHOT = 1
+    RECORD_REPEAT = 2
+    HEADER = struct.Struct('<BI')
+    COUNT = struct.Struct('<H')
+
+    def __init__(self, writer, directory=HISTORY_DIR):
+        self.writer = writer
+        self.directory = directory
+        self.items_file = os.path.join(directory, 'items.json')
+        self.names = self._load_names()
+        self.ids = {name: item_id for item_id, name in enumerate(self.names)}
+        self.last_day = None
+        self.last_snapshot = None
+        self.records = 0
+        self.bytes_written = 0
+        self._seq = itertools.count()
+
+    def _load_names(self):
+        try:
+            with open(self.items_file, 'r', encoding='utf-8') as f:
+                names = json.load(f)
+            return names if isinstance(names, list) else []
+        except (FileNotFoundError, json.JSONDecodeError):
+            return []
+
+    @staticmethod
+    def day_of(timestamp):
+        return datetime.fromtimestamp(timestamp, timezone.utc).date()
+
+    def day_file(self, day):
+        return os.path.join(self.directory, f"{day.isoformat()}.bin")
+
+    def item_id(self, name):
+        """Номер предмета в словаре; новые предметы дописываются в items.json"""
+        item_id = self.ids.get(name)
+        if item_id is None:
+            item_id = len(self.names)
+            self.names.append(name)
+            self.ids[name] = item_id
+            self.writer.submit(self.items_file, self._write_names, list(self.names))
+        return item_id
+
+    @staticmethod
+    def _column_bytes(column):
+        if sys.byteorder == 'big':
+            column = array(column.typecode, column)
+            column.byteswap()
+        return column.tobytes()
+
+    @staticmethod
+    def _column(typecode, data):
+        column = array(typecode)
+        column.frombytes(data)
+        if sys.byteorder == 'big':
+            column.byteswap()
+        return column
+
+    def encode(self, snapshot, timestamp):
+        """Кодирует снимок {категория: {предмет: количество}} в запись"""
+        ids, categories, quantities = array('H'), array('B'), array('H')
+        for category_index, category in enumerate(STOCK_CATEGORIES):
+            for name, quantity in snapshot.get(category, {}).items():
+                ids.append(self.item_id(name))
+                categories.append(category_index)
+                quantities.append(min(max(int(quantity), 0), 0xFFFF))
+        return b''.join((
+            self.HEADER.pack(self.RECORD_SNAPSHOT, int(timestamp)),
+            self.COUNT.pack(len(ids)),
+            self._column_bytes(ids),
+            self._column_bytes(categories),
+            self._column_bytes(quantities)
+        ))
+
+    def record(self, snapshot, timestamp=None):
+        """Добавляет опрос в историю; неизменившийся сток пишется маркером повтора"""
+        timestamp = time.time() if timestamp is None else timestamp
+        day = self.day_of(timestamp)
+        if day == self.last_day and snapshot == self.last_snapshot:
+            data = self.HEADER.pack(self.RECORD_REPEAT, int(timestamp))
+        else:
+            # Каждый файл дня начинается с полного снимка
+            data = self.encode(snapshot, timestamp)
+            self.last_day = day
+            self.last_snapshot = snapshot
+        self.records += 1
+        self.bytes_written += len(data)
+        self.writer.submit(('history', next(self._seq)), self._append, self.day_file(day), data)
+
+    def _write_names(self, names):
+        os.makedirs(self.directory, exist_ok=True)
+        write_json_file(self.items_file, names, None)
+
+    def _append(self, filename, data):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(filename, 'ab') as f:
+            f.write(data)
+
+    def _parse(self, data, since=0, until=float('inf')):
+        offset, size = 0, len(data)
+        current = None
+        while offset + self.HEADER.size <= size:
+            kind, timestamp = self.HEADER.unpack_from(data, offset)
+            offset += self.HEADER.size
+            if kind == self.RECORD_SNAPSHOT:
+                if offset + self.COUNT.size > size:
+                    break
+                (count,) = self.COUNT.unpack_from(data, offset)
+                offset += self.COUNT.size
+                if offset + count * 5 > size:
+                    # Запись оборвана (сбой во время дозаписи)
+                    break
+                ids = self._column('H', data[offset:offset + count * 2])
+                categories = self._column('B', data[offset + count * 2:offset + count * 3])
+                quantities = self._column('H', data[offset + count * 3:offset + count * 5])
+                offset += count * 5
+                current = (ids, categories, quantities)
+            elif kind != self.RECORD_REPEAT:
+                logger.warning(f"⚠️ Поврежденная запись истории (тип {kind}), остаток файла пропущен")
+                break
+            if current is not None and since <= timestamp <= until:
+                yield timestamp, current
+
+    def iter_records(self, since=None, until=None):
+        """Опросы за период: (время, (номера, категории, количества)), повторы развернуты
+
+        Для повторов возвращается тот же объект колонок, что и у снимка.
+        """
+        until = time.time() if until is None else until
+        since = until - 86400 if since is None else since
+        day, last_day = self.day_of(since), self.day_of(until)
+        while day <= last_day:
+            yield from self._parse(self.read_day(day), since, until)
+            day += timedelta(days=1)
+
+    def read_day(self, day):
+        """Содержимое файла дня (b'', если файла нет)"""
+        try:
+            with open(self.day_file(day), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return b''
+
+    def query(self, item, since=None, until=None):
+        """Ряд количеств предмета за период: (array времен 'I', array количеств 'H')
+
+        Опросы, в которых предмета не было, дают количество 0.
+        """
+        item_id = self.ids.get(item)
+        timestamps, quantities = array('I'), array('H')
+        columns, quantity = None, 0
+        for timestamp, current in self.iter_records(since, until):
+            if current is not columns:
+                columns = current
+                ids, _, column = current
+                quantity = 0
+                if item_id is not None:
+                    quantity = min(sum(q for i, q in zip(ids, column) if i == item_id), 0xFFFF)
+            timestamps.append(timestamp)
+            quantities.append(quantity)
+        return timestamps, quantities
+
+    def summarize(self, item, days=7, now=None):
+        """Сводка по предмету: как часто появлялся, в каком количестве и в какие часы (UTC)"""
+        now = time.time() if now is None else now
+        timestamps, quantities = self.query(item, now - days * 86400, now)
+        summary = {
+            'polls': len(timestamps),
+            'present': 0,
+            'appearances': 0,
+            'quantities': collections.Counter(),
+            'hours': collections.Counter(),
+            'last_seen': None
+        }
+        previous = 0
+        for timestamp, quantity in zip(timestamps, quantities):
+            if quantity:
+                summary['present'] += 1
+                summary['last_seen'] = timestamp
+                if not previous:
+                    summary['appearances'] += 1
+                    summary['quantities'][quantity] += 1
+                    summary['hours'][time.gmtime(timestamp).tm_hour] += 1
+            previous = quantity
+        return summary
+
+    def describe(self):
+        return (
+            f"📜 История: {self.records} записей за запуск ({self.bytes_written / 1024:.1f} КиБ), "
+            f"предметов в словаре: {len(self.names)}"
+        )
+
+class StockAnalytics:
+    """Векторизованная аналитика по истории стока (NumPy)
+
+    Файлы дней только дописываются, поэтому каждый день разбирается
+    один раз (и заново, только если вырос размер файла) и кэшируется в виде
+    массивов: время опроса, номер уникального снимка и матрица снимок x
+    предмет с количествами. В кэше остаются только дни последнего
+    запрошенного окна.
+    Ряд предмета за период - выборка столбца матрицы по номерам снимков,
+    дальше все считается операциями над массивами без циклов Python.
+    """
+
+    def __init__(self, history):
+        self.history = history
+        self.days = {}
+        self.item_categories = {}
+
+    def _load_day(self, day):
+        try:
+            size = os.path.getsize(self.history.day_file(day))
+        except OSError:
+            size = 0
+        cached = self.days.get(day)
+        if cached is not None and cached[0] == size:
+            return cached
+        data = self.history.read_day(day)
+        times, snapshot_index, snapshots = array('I'), array('I'), []
+        last = None
+        for timestamp, columns in self.history._parse(data):
+            if columns is not last:
+                snapshots.append(columns)
+                last = columns
+            times.append(timestamp)
+            snapshot_index.append(len(snapshots) - 1)
+
+        width = max([len(self.history.names)] + [max(ids) + 1 for ids, _, _ in snapshots if ids])
+        matrix = np.zeros((len(snapshots), width), dtype=np.uint16)
+        for row, (ids, categories, quantities) in enumerate(snapshots):
+            if ids:
+                ids = np.frombuffer(ids, dtype=np.uint16)
+                # Предмет в нескольких категориях суммируется, как в StockHistory.query
+                totals = np.bincount(ids, weights=np.frombuffer(quantities, dtype=np.uint16), minlength=width)
+                matrix[row] = np.minimum(totals, 0xFFFF)
+                self.item_categories.update(zip(ids.tolist(), categories))
+        cached = (
+            len(data),
+            np.frombuffer(times, dtype=np.uint32).astype(np.int64),
+            np.frombuffer(snapshot_index, dtype=np.uint32),
+            matrix
+        )
+        self.days[day] = cached
+        return cached
+
+    def warm(self, days=14, now=None):
+        """Заранее разбирает файлы последних дней, чтобы первый /forecast был быстрым"""
+        now = time.time() if now is None else now
+        day = self.history.day_of(now - days * 86400)
+        while day <= self.history.day_of(now):
+            self._load_day(day)
+            day += timedelta(days=1)
+
+    def series(self, item, since, until):
+        """Ряд предмета за период: (времена int64, количества uint16)"""
+        item_id = self.history.ids.get(item)
+        times, quantities = [], []
+        first_day, last_day = self.history.day_of(since), self.history.day_of(until)
+        # Кэш ограничен окном запроса
+        for cached_day in list(self.days):
+            if not first_day <= cached_day <= last_day:
+                self.days.pop(cached_day, None)
+        day = first_day
+        while day <= last_day:
+            _, day_times, snapshot_index, matrix = self._load_day(day)
+            if item_id is not None and item_id < matrix.shape[1]:
+                day_quantities = matrix[:, item_id][snapshot_index]
+            else:
+                day_quantities = np.zeros(len(day_times), dtype=np.uint16)
+            times.append(day_times)
+            quantities.append(day_quantities)
+            day += timedelta(days=1)
+        times = np.concatenate(times)
+        quantities = np.concatenate(quantities)
+        mask = (times >= since) & (times <= until)
+        return times[mask], quantities[mask]
+
+    def forecast(self, item, days=14, cycles=None, now=None):
+        """Частота появлений, интервалы между ними, количества и вероятность
+        появления в следующем рестоке
+
+        cycles - {категория: (период сек., ближайший дедлайн или None)}.
+        Вероятность - доля циклов рестока (из тех, что бот наблюдал), в
+        которых предмет был в стоке.
+        """
+        started = time.perf_counter()
+        now = time.time() if now is None else now
+        times, quantities = self.series(item, now - days * 86400, now)
+        result = {'item': item, 'days': days, 'polls': int(times.size)}
+        if not times.size:
+            return result
+
+        present = quantities > 0
+        starts = np.flatnonzero(present & ~np.concatenate(([False], present[:-1])))
+        observed_days = max((times[-1] - times[0]) / 86400, 1 / 24)
+        result.update({
+            'presence': float(present.mean()),
+            'appearances': int(starts.size),
+            'per_day': float(starts.size / observed_days),
+            'last_seen': int(times[present][-1]) if present.any() else None
+        })
+        if starts.size:
+            result['quantity'] = np.percentile(quantities[starts], [10, 50, 90]).tolist()
+        if starts.size > 1:
+            result['interval'] = np.percentile(np.diff(times[starts]), [10, 50, 90]).tolist()
+
+        item_id = self.history.ids.get(item)
+        category_index = self.item_categories.get(item_id)
+        if category_index is not None:
+            category = STOCK_CATEGORIES[category_index]
+            period, next_deadline = (cycles or {}).get(category, (DEFAULT_RESTOCK_PERIODS.get(category), None))
+            if period:
+                phase = next_deadline % period if next_deadline else 0
+                cycle_ids = (times - phase) // period
+                observed = np.unique(cycle_ids)
+                hits = np.unique(cycle_ids[present])
+                result.update({
+                    'category': category,
+                    'period': int(period),
+                    'cycles': int(observed.size),
+                    'probability': float(hits.size / observed.size),
+                    'next_restock': next_deadline
+                })
+        result['elapsed_ms'] = (time.perf_counter() - started) * 1000
+        return result
+
+class SubscriptionRouter:
+    """Маршрутизация событий стока по подпискам каналов
+
+    Подписка канала: {'items': [...], 'categories': [...], 'min_quantity': N}.
+    Канал без подписки (или с пустыми items и categories) получает все
+    отслеживаемые предметы. Подписки компилируются в обратный индекс
+    предмет/категория -> каналы, поэтому событие доходит до своих
+    подписчиков без перебора всех каналов.
+    """
+
+    def __init__(self, channels=None):
+        self.by_item = {}
+        self.by_category = {}
+        self.everyone = []
+        if channels:
+            self.rebuild(channels)
+
+    @staticmethod
+    def subscription(channel_info):
+        """Подписка канала: (items, categories, min_quantity)"""
+        subscription = channel_info.get('subscription') or {}
+        return (
+            frozenset(subscription.get('items', ())),
+            frozenset(subscription.get('categories', ())),
+            max(1, int(subscription.get('min_quantity', 1)))
+        )
+
+    def rebuild(self, channels):
+        """Перестраивает индекс по словарю одобренных каналов"""
+        by_item, by_category, everyone = {}, {}, []
+        for channel_id, channel_info in channels.items():
+            items, categories, min_quantity = self.subscription(channel_info)
+            route = (channel_id, min_quantity)
+            if not items and not categories:
+                everyone.append(route)
+                continue
+            for item in items:
+                by_item.setdefault(item, []).append(route)
+            for category in categories:
+                by_category.setdefault(category, []).append(route)
+        self.by_item, self.by_category, self.everyone = by_item, by_category, everyone
+
+    def route(self, events):
+        """Раскладывает события по каналам: {channel_id: [события]}"""
+        routed = {}
+        for event in events:
+            for routes in (self.everyone, self.by_item.get(event.name, ()), self.by_category.get(event.category, ())):
+                for channel_id, min_quantity in routes:
+                    if event.new < min_quantity:
+                        continue
+                    channel_events = routed.setdefault(channel_id, [])
+                    # Канал мог подписаться и на предмет, и на его категорию
+                    if not channel_events or channel_events[-1] is not event:
+                        channel_events.append(event)
+        return routed
+
+class EventCoalescer:
+    """Копит события стока и отдает их одной пачкой
+
+    Пачка уходит, когда события перестали приходить settle сек. (рестокинг
+    устоялся) или через window сек. после первого события - что раньше.
+    Копятся события всех типов: события одного предмета сворачиваются в
+    одно по итоговому изменению (старое количество - из первого, новое -
+    из последнего), так что предмет, который появился и исчез внутри окна,
+    не объявляется. Перед отправкой пачка сверяется с текущим снимком
+    (snapshot()), и наружу уходят только события из NOTIFY_EVENTS.
+    window = 0 отключает накопление.
+    """
+
+    def __init__(self, emit, window=8.0, settle=2.0, snapshot=None):
+        self.emit = emit   # async emit(events)
+        self.snapshot = snapshot
+        self.window = window
+        self.settle = settle
+        self.pending = {}
+        self.first_at = None
+        self.last_at = None
+        self.handle = None
+        self.flush_task = None
+        self.events_in = 0
+        self.batches = 0
+
+    @staticmethod
+    def merge(old, new):
+        """Сворачивает два события одного предмета; None, если итогового изменения нет"""
+        before, after = old.old, new.new
+        if after <= 0:
+            if before <= 0:
+                # Появился и исчез внутри окна
+                return None
+            kind = EVENT_DISAPPEARED
+        elif before <= 0:
+            kind = EVENT_APPEARED
+        elif {old.kind, new.kind} & {EVENT_APPEARED, EVENT_RESTOCKED}:
+            # Исчез и вернулся или прошел рестокинг
+            kind = EVENT_RESTOCKED
+        elif after > before:
+            kind = EVENT_QUANTITY_UP
+        elif after < before:
+            kind = EVENT_QUANTITY_DOWN
+        else:
+            return None
+        return StockEvent(kind, new.category, new.name, before, after)
+
+    async def add(self, events):
+        """Добавляет события; при выключенном накоплении отдает их сразу"""
+        if not events:
+            return
+        self.events_in += len(events)
+        if self.window <= 0:
+            notify_events = [event for event in events if event.kind in NOTIFY_EVENTS]
+            if notify_events:
+                self.batches += 1
+                await self.emit(notify_events)
+            return
+        now = time.monotonic()
+        for event in events:
+            key = (event.category, event.name)
+            previous = self.pending.get(key)
+            merged = event if previous is None else self.merge(previous, event)
+            if merged is None:
+                del self.pending[key]
+            else:
+                self.pending[key] = merged
+        if self.first_at is None:
+            self.first_at = now
+        self.last_at = now
+        self._schedule(now)
+
+    def _schedule(self, now):
+        if self.handle is not None:
+            self.handle.cancel()
+        delay = max(0.0, min(self.last_at + self.settle, self.first_at + self.window) - now)
+        self.handle = asyncio.get_running_loop().call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        self.handle = None
+        self.flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    async def close(self):
+        """Отменяет отложенную пачку и дожидается уже начатой отправки
+
+        Накопленные события не теряются: снимок для них еще не сохранен,
+        после перезапуска они будут найдены заново.
+        """
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.flush_task is not None:
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+            self.flush_task = None
+
+    async def flush(self):
+        """Отдает накопленные события одной пачкой"""
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.first_at is None:
+            return
+        events = [event for event in self.pending.values() if event.kind in NOTIFY_EVENTS]
+        current = self.snapshot() if self.snapshot is not None else None
+        if current is not None:
+            # Предмет мог уйти из стока уже после последнего события
+            events = [event for event in events if current.get(event.category, {}).get(event.name, 0) > 0]
+        waited = time.monotonic() - self.first_at
+        self.pending = {}
+        self.first_at = self.last_at = None
+        self.batches += 1
+        logger.info(f"🧺 Пачка событий: {len(events)} шт. за {waited:.1f} сек.")
+        # emit вызывается и для пустой пачки: по нему сохраняется снимок стока
+        try:
+            await self.emit(events)
+        except Exception as e:
+            logger.error(f"❌ Ошибка отправки пачки событий: {e}")
+
+    def describe(self):
+        if self.window <= 0:
+            return "🧺 Объединение событий: выключено"
+        return (
+            f"🧺 Объединение событий: до {self.window:g} сек. (тишина {self.settle:g} сек.), "
+            f"событий: {self.events_in}, пачек: {self.batches}"
+        )
+
+DEFAULT_LOCALE = 'ru'
+
+# Шаблоны сообщений по локалям; строки компилируются в MessageRenderer
+MESSAGE_TEMPLATES = {
+    'ru': {
+        'title_update': "🎯 *ОБНОВЛЕНИЕ СТОКА!* ({count} шт.)",
+        'title_single': "🎯 *НОВЫЙ ПРЕДМЕТ В СТОКЕ!*",
+        'title_many': "🎯 *НОВЫЕ ПРЕДМЕТЫ В СТОКЕ!* ({count} шт.)",
+        EVENT_APPEARED: "🟢 *{name}* — `{new}` шт.",
+        EVENT_QUANTITY_UP: "🔼 *{name}* — `{old}` → `{new}` шт.",
+        EVENT_RESTOCKED: "🔄 *{name}* — `{new}` шт. (рестокинг)",
+        'footer': "⏰ *Обновлено:* {time}\n\n🔔 *Garden Stock Bot*",
+        'board_title': "📋 *ЖИВОЙ СТОК*",
+        'board_category': "*{category}*",
+        'board_item': "• *{name}* — `{quantity}` шт.",
+        'board_empty': "Сейчас в стоке нет отслеживаемых предметов",
+        'board_footer': "🔔 *Garden Stock Bot*",
+        # Заголовки как до появления локалей: иначе при следующей правке
+        # изменились бы все уже опубликованные табло
+        'categories': {category: category[:-len('Stock')].title() for category in STOCK_CATEGORIES}
+    },
+    'en': {
+        'title_update': "🎯 *STOCK UPDATE!* ({count} items)",
+        'title_single': "🎯 *NEW ITEM IN STOCK!*",
+        'title_many': "🎯 *NEW ITEMS IN STOCK!* ({count} items)",
+        EVENT_APPEARED: "🟢 *{name}* — `{new}` pcs",
+        EVENT_QUANTITY_UP: "🔼 *{name}* — `{old}` → `{new}` pcs",
+        EVENT_RESTOCKED: "🔄 *{name}* — `{new}` pcs (restock)",
+        'footer': "⏰ *Updated:* {time}\n\n🔔 *Garden Stock Bot*",
+        'board_title': "📋 *LIVE STOCK*",
+        'board_category': "*{category}*",
+        'board_item': "• *{name}* — `{quantity}` pcs",
+        'board_empty': "No tracked items in stock right now",
+        'board_footer': "🔔 *Garden Stock Bot*",
+        'categories': {
+            'easterStock': "🐣 Easter",
+            'gearStock': "🛠 Gear",
+            'eggStock': "🥚 Eggs",
+            'nightStock': "🌙 Night",
+            'honeyStock': "🍯 Honey",
+            'cosmeticsStock': "💄 Cosmetics",
+            'seedsStock': "🌱 Seeds"
+        }
+    }
+}
+
+class MessageRenderer:
+    """Рендер сообщений по шаблонам с кэшем готовых текстов
+
+    Шаблоны компилируются один раз (в связанные str.format). Готовый текст
+    кэшируется по (содержимое, локаль): все каналы с одинаковыми событиями
+    и языком получают один и тот же объект строки, а табло с неизменившимся
+    стоком не перерисовывается.
+    """
+
+    def __init__(self, display_name=str.title, templates=MESSAGE_TEMPLATES, cache_size=256):
+        self.display_name = display_name
+        self.compiled = {
+            locale: {key: value.format if isinstance(value, str) else value for key, value in template.items()}
+            for locale, template in templates.items()
+        }
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+    def locale(self, locale):
+        return locale if locale in self.compiled else DEFAULT_LOCALE
+
+    def _cached(self, key, build):
+        text = self.cache.get(key)
+        if text is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return text
+        self.misses += 1
+        text = build()
+        self.cache[key] = text
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return text
+
+    def stock_message(self, events, locale=DEFAULT_LOCALE, stamp=None):
+        """Сообщение о событиях стока; stamp - время в подписи (одно на рассылку)"""
+        events = tuple(events)
+        if not events:
+            return None
+        locale = self.locale(locale)
+        stamp = stamp or datetime.now().strftime('%H:%M:%S')
+        return self._cached(('stock', events, locale, stamp), lambda: self._render_stock(events, locale, stamp))
+
+    def _render_stock(self, events, locale, stamp):
+        template = self.compiled[locale]
+        if any(event.kind != EVENT_APPEARED for event in events):
+            title = template['title_update'](count=len(events))
+        elif len(events) == 1:
+            title = template['title_single']()
+        else:
+            title = template['title_many'](count=len(events))
+        lines = [
+            template.get(event.kind, template[EVENT_APPEARED])(
+                name=self.display_name(event.name), old=event.old, new=event.new
+            )
+            for event in events
+        ]
+        return f"{title}\n\n" + '\n'.join(lines) + f"\n\n{template['footer'](time=stamp)}"
+
+    def board(self, entries, locale=DEFAULT_LOCALE):
+        """Текст живого табло; entries - ((категория, ((предмет, количество), ...)), ...)"""
+        entries = tuple(entries)
+        locale = self.locale(locale)
+        return self._cached(('board', entries, locale), lambda: self._render_board(entries, locale))
+
+    def _render_board(self, entries, locale):
+        template = self.compiled[locale]
+        parts = [template['board_title']()]
+        for category, items in entries:
+            parts.append('')
+            parts.append(template['board_category'](category=template['categories'].get(category, category)))
+            parts.extend(template['board_item'](name=self.display_name(name), quantity=quantity) for name, quantity in items)
+        if not entries:
+            parts.extend(('', template['board_empty']()))
+        parts.extend(('', template['board_footer']()))
+        return '\n'.join(parts)
+
+    def describe(self):
+        return f"🖨 Кэш рендера: {len(self.cache)} текстов, попаданий {self.hits}, промахов {self.misses}"
+
+def parse_category(name):
+    """Категория стока по названию: eggStock, eggs, egg, gear, seeds..."""
+    if name in STOCK_CATEGORIES:
+        return name
+    return timer_category(name) if len(name) >= 3 else None
+
+def percentile(values, fraction):
+    """Перцентиль по отсортированной копии значений"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+class TokenBucket:
+    """Глобальный лимит отправок Telegram (~30 сообщений в секунду)
+
+    capacity - допустимый всплеск. Полный бак плюс пополнение дают за первую
+    секунду rate + capacity отправок, поэтому всплеск держим минимальным,
+    иначе Telegram отвечает 429 и останавливает всю рассылку.
+    """
+
+    def __init__(self, rate=30, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = self.capacity
+        self.updated = None
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        """Ждет, пока появится свободный токен"""
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            if self.updated is None:
+                self.updated = now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Приостанавливает все отправки (RetryAfter от Telegram)"""
+        now = asyncio.get_running_loop().time()
+        self.paused_until = max(self.paused_until, now + seconds)
+
+class ChatRateLimiter:
+    """Лимит отправок в один чат (не чаще одного сообщения в interval секунд)"""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.next_allowed = {}
+
+    async def wait(self, chat_id):
+        """Резервирует ближайший слот для чата и ждет его"""
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self.next_allowed.get(chat_id, 0.0))
+        self.next_allowed[chat_id] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def defer(self, chat_id, seconds):
+        """Откладывает следующую отправку в чат"""
+        now = asyncio.get_running_loop().time()
+        self.next_allowed[chat_id] = max(self.next_allowed.get(chat_id, 0.0), now + seconds)
+
+class BroadcastBatch:
+    """Одна рассылка: отслеживает доставку и задержку по каждому каналу"""
+
+    def __init__(self, total):
+        self.started = asyncio.get_running_loop().time()
+        self.pending = total
+        self.delivered = {}
+        self.latencies = {}
+        self.failed = {}
+        self.permanent = []
+        self.deferred = []
+        self.duplicates = 0
+        self.done = asyncio.Event()
+        if total == 0:
+            self.done.set()
+
+    def _finish_one(self):
+        self.pending -= 1
+        if self.pending <= 0:
+            self.done.set()
+
+    def mark_delivered(self, chat_id, message_id):
+        self.delivered[chat_id] = message_id
+        self.latencies[chat_id] = asyncio.get_running_loop().time() - self.started
+        self._finish_one()
+
+    def mark_failed(self, chat_id, error, permanent=False):
+        self.failed[chat_id] = error
+        if permanent:
+            self.permanent.append(chat_id)
+        self._finish_one()
+
+    def mark_deferred(self, chat_id):
+        """Доставка отложена на повтор - рассылка ее больше не ждет"""
+        self.deferred.append(chat_id)
+        self._finish_one()
+
+    def report(self):
+        """Итог рассылки с перцентилями задержки доставки"""
+        latencies = list(self.latencies.values())
+        return {
+            'delivered': self.delivered,
+            'latencies': self.latencies,
+            'failed': self.failed,
+            'permanent': self.permanent,
+            'deferred': self.deferred,
+            'duplicates': self.duplicates,
+            'first': min(latencies) if latencies else 0.0,
+            'p50': percentile(latencies, 0.5),
+            'p95': percentile(latencies, 0.95),
+            'last': max(latencies) if latencies else 0.0
+        }
+
+class OutboundQueue:
+    """Журнал исходящих сообщений на диске для доставки at-least-once
+
+    Каждая строка файла - JSON запись: put (новое сообщение), ack (доставлено)
+    или drop (отброшено). При запуске журнал проигрывается, недоставленные
+    сообщения возвращаются в очередь, а журнал сжимается.
+    """
+
+    def __init__(self, writer, filename=OUTBOX_FILE, remember=5000, dedup_ttl=3600, compact_every=1000):
+        self.writer = writer
+        self.filename = filename
+        self.remember = remember
+        self.dedup_ttl = dedup_ttl
+        self.compact_every = compact_every
+        self.pending = {}
+        self.pending_keys = set()
+        self.done_keys = collections.OrderedDict()
+        self.records_since_compact = 0
+
+    def _remember(self, key, at):
+        if not key:
+            return
+        self.done_keys[key] = at
+        self.done_keys.move_to_end(key)
+        while len(self.done_keys) > self.remember:
+            self.done_keys.popitem(last=False)
+
+    def _forget_pending(self, job_id):
+        job = self.pending.pop(job_id, None)
+        if job is not None:
+            self.pending_keys.discard(job.get('key'))
+        return job
+
+    def is_duplicate(self, key, now=None):
+        """Сообщение с таким ключом уже в очереди или недавно доставлено"""
+        now = time.time() if now is None else now
+        if key in self.pending_keys:
+            return True
+        done_at = self.done_keys.get(key)
+        return done_at is not None and now - done_at < self.dedup_ttl
+
+    def _replay(self):
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Недописанная строка после падения процесса
+                        continue
+                    op = record.get('op')
+                    if op == 'put':
+                        job = {k: v for k, v in record.items() if k != 'op'}
+                        job['attempts'] = 0
+                        if job.get('board'):
+                            job.setdefault('edit_message_id', None)
+                        self.pending[job['id']] = job
+                        self.pending_keys.add(job.get('key'))
+                    elif op in ('ack', 'drop'):
+                        self._forget_pending(record.get('id'))
+                        self._remember(record.get('key'), record.get('at', 0))
+        except FileNotFoundError:
+            pass
+        self._write_compacted(self._compacted_lines())
+
+    async def load(self):
+        """Проигрывает журнал в потоке писателя и возвращает недоставленные сообщения"""
+        await self.writer.run(self._replay)
+        return list(self.pending.values())
+
+    def _write_lines(self, lines, sync):
+        with open(self.filename, 'a', encoding='utf-8') as f:
+            f.writelines(lines)
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+
+    def _lines(self, records):
+        self.records_since_compact += len(records)
+        return [json.dumps(record, ensure_ascii=False) + '\n' for record in records]
+
+    def _maybe_compact(self):
+        if self.records_since_compact >= self.compact_every:
+            # Снимок состояния берется в event loop, запись - в потоке писателя,
+            # после всех ранее поставленных дозаписей
+            self.writer.submit(('outbox-compact', self.filename), self._write_compacted, self._compacted_lines())
+
+    async def put_many(self, jobs):
+        """Журналирует новые сообщения одной записью с fsync, пропуская дубликаты"""
+        now = time.time()
+        accepted = [job for job in jobs if not self.is_duplicate(job['key'], now)]
+        if not accepted:
+            return []
+        for job in accepted:
+            self.pending[job['id']] = job
+            self.pending_keys.add(job['key'])
+        await self.writer.run(self._write_lines, self._lines([self._put_record(job) for job in accepted]), True)
+        self._maybe_compact()
+        return accepted
+
+    @staticmethod
+    def _put_record(job):
+        record = {
+            'op': 'put',
+            'id': job['id'],
+            'key': job['key'],
+            'chat_id': job['chat_id'],
+            'text': job['text'],
+            'priority': job.get('priority', 0),
+            'created': job.get('created')
+        }
+        if job.get('board'):
+            # Без этих полей правка табло после перезапуска ушла бы обычным сообщением
+            record['board'] = True
+            record['edit_message_id'] = job.get('edit_message_id')
+        return record
+
+    def _finish(self, job, op):
+        now = time.time()
+        self._forget_pending(job['id'])
+        self._remember(job['key'], now)
+        lines = self._lines([{'op': op, 'id': job['id'], 'key': job['key'], 'at': now}])
+        self.writer.submit(('outbox', job['id'], op), self._write_lines, lines, False)
+        self._maybe_compact()
+
+    def ack(self, job):
+        """Отмечает сообщение доставленным"""
+        self._finish(job, 'ack')
+
+    def drop(self, job):
+        """Отбрасывает сообщение без повторов"""
+        self._finish(job, 'drop')
+
+    def _compacted_lines(self):
+        self.records_since_compact = 0
+        lines = [
+            json.dumps({'op': 'ack', 'id': None, 'key': key, 'at': at}, ensure_ascii=False) + '\n'
+            for key, at in self.done_keys.items()
+        ]
+        lines.extend(json.dumps(self._put_record(job), ensure_ascii=False) + '\n' for job in self.pending.values())
+        return lines
+
+    def _write_compacted(self, lines):
+        """Перезаписывает журнал: только недоставленные сообщения и недавние ключи"""
+        tmp_filename = self.filename + '.tmp'
+        try:
+            with open(tmp_filename, 'w', encoding='utf-8') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filename, self.filename)
+        except Exception as e:
+            logger.error(f"❌ Ошибка сжатия журнала {self.filename}: {e}")
+
+class Broadcaster:
+    """Параллельная рассылка с пулом воркеров, лимитами Telegram и журналом на диске"""
+
+    def __init__(self, writer, workers=8, global_rate=30, per_chat_interval=1.0, max_attempts=6,
+                 retry_base=2.0, retry_max=300.0, outbox=None):
+        self.workers = workers
+        self.bucket = TokenBucket(global_rate)
+        self.chat_limiter = ChatRateLimiter(per_chat_interval)
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.outbox = outbox or OutboundQueue(writer)
+        self.telegram = None
+        self.queue = None
+        self.tasks = []
+        self.batches = {}
+        self.on_delivered = None
+        self.on_failed = None
+        self._seq = itertools.count()
+
+    async def start(self, telegram_bot):
+        """Запускает воркеры (один раз, внутри event loop) и поднимает недоставленное из журнала"""
+        self.telegram = telegram_bot
+        if self.tasks:
+            return
+        self._start_workers()
+
+        recovered = await self.outbox.load()
+        for job in recovered:
+            self._enqueue(job)
+        if recovered:
+            logger.info(f"♻️ Восстановлено {len(recovered)} недоставленных сообщений из {self.outbox.filename}")
+
+    async def stop(self):
+        """Останавливает воркеры; недоставленное останется в журнале"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def _start_workers(self):
+        self.queue = asyncio.PriorityQueue()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"📮 Запущено {self.workers} воркеров рассылки")
+
+    def _enqueue(self, job):
+        self.queue.put_nowait((-job.get('priority', 0), next(self._seq), job))
+
+    def describe(self):
+        return f"📮 Доставка: в процессе бота, воркеров: {self.workers}, в журнале: {len(self.outbox.pending)}"
+
+    async def update_board(self, telegram_bot, chat_id, text, message_id=None, priority=0):
+        """Ставит в очередь правку живого табло (или его публикацию, если message_id нет)
+
+        Правка проходит через тот же журнал, воркеры и лимиты, что и рассылка,
+        но не ждет доставки.
+        """
+        await self.start(telegram_bot)
+        job = {
+            'id': uuid.uuid4().hex,
+            'key': f"{chat_id}:board:{next(self._seq)}:{time.time()}",
+            'chat_id': str(chat_id),
+            'text': text,
+            'priority': priority,
+            'created': time.time(),
+            'attempts': 0,
+            'board': True,
+            'edit_message_id': message_id
+        }
+        for accepted in await self.outbox.put_many([job]):
+            self._enqueue(accepted)
+
+    async def broadcast(self, telegram_bot, deliveries, snapshot_key):
+        """Ставит рассылку в журнал и очередь; возвращает BroadcastBatch, не дожидаясь доставки
+
+        deliveries - список (priority, chat_id, text); больший priority отправляется раньше.
+        Повторная рассылка того же снимка в тот же канал пропускается.
+        batch.done срабатывает после первой попытки доставки во все каналы.
+        """
+        await self.start(telegram_bot)
+        now = time.time()
+        jobs = [
+            {
+                'id': uuid.uuid4().hex,
+                'key': f"{chat_id}:{snapshot_key}",
+                'chat_id': str(chat_id),
+                'text': text,
+                'priority': priority,
+                'created': now,
+                'attempts': 0
+            }
+            for priority, chat_id, text in deliveries
+        ]
+        accepted = await self.outbox.put_many(jobs)
+        batch = BroadcastBatch(len(accepted))
+        batch.duplicates = len(jobs) - len(accepted)
+        for job in accepted:
+            self.batches[job['id']] = batch
+            self._enqueue(job)
+        return batch
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self.queue.get()
+            try:
+                await self._deliver(job)
+            except Exception as e:
+                logger.error(f"❌ Ошибка воркера рассылки: {e}")
+                # Повторяем только то, что еще не подтверждено в журнале
+                if job['id'] in self.outbox.pending:
+                    self._retry(job)
+            finally:
+                self.queue.task_done()
 
-# Веб-сервер для Replit
-app = Flask('')
+    @staticmethod
+    def retry_after_seconds(error):
+        retry_after = error.retry_after
+        if isinstance(retry_after, timedelta):
+            return retry_after.total_seconds()
+        return float(retry_after)
 
-@app.route('/')
-def home():
-    return "🌿 Garden Stock Bot is running!"
+    async def _deliver(self, job):
+        chat_id = job['chat_id']
+        await self.chat_limiter.wait(chat_id)
+        await self.bucket.acquire()
+        try:
+            message_id = await self._send_or_edit(job)
+        except RetryAfter as e:
+            delay = self.retry_after_seconds(e)
+            logger.warning(f"⏳ Лимит Telegram, пауза {delay:.0f} сек. (канал {chat_id})")
+            self.bucket.pause(delay)
+            self.chat_limiter.defer(chat_id, delay)
+            self._retry(job, delay)
+            return
+        except (BadRequest, Forbidden) as e:
+            error_msg = str(e)
+            permanent = isinstance(e, Forbidden) or any(err in error_msg for err in PERMANENT_SEND_ERRORS)
+            logger.error(f"❌ Ошибка отправки в канал {chat_id}: {error_msg}")
+            self._fail(job, error_msg, permanent)
+            return
+        except NetworkError as e:
+            logger.warning(f"⚠️ Сетевая ошибка при отправке в {chat_id} (попытка {job['attempts'] + 1}): {e}")
+            self._retry(job)
+            return
+        self._delivered(job, message_id)
 
-def run_web():
-    app.run(host='0.0.0.0', port=8080)
+    def _delivered(self, job, message_id):
+        self.outbox.ack(job)
+        batch = self.batches.pop(job['id'], None)
+        if batch is not None:
+            batch.mark_delivered(job['chat_id'], message_id)
+        if self.on_delivered:
+            self.on_delivered(job['chat_id'], message_id, job)
+
+    async def _send_or_edit(self, job):
+        """Отправляет сообщение или правит уже опубликованное; возвращает ID сообщения
+
+        Если сообщение для правки удалено, публикуется новое. Новое табло
+        закрепляется в канале.
+        """
+        chat_id = job['chat_id']
+        message_id = job.get('edit_message_id')
+        if message_id:
+            try:
+                await self.telegram.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text=job['text'],
+                    parse_mode='Markdown',
+                    disable_web_page_preview=True
+                )
+                return message_id
+            except BadRequest as e:
+                error_msg = str(e).lower()
+                if 'not modified' in error_msg:
+                    return message_id
+                if 'message to edit not found' not in error_msg and "can't be edited" not in error_msg:
+                    raise
+                logger.warning(f"📋 Табло в канале {chat_id} недоступно для правки, публикуем новое")
+                job['edit_message_id'] = None
+                await self.bucket.acquire()
+
+        sent_message = await self.telegram.send_message(
+            chat_id=chat_id,
+            text=job['text'],
+            parse_mode='Markdown',
+            disable_web_page_preview=True
+        )
+        if job.get('board'):
+            # Сообщение уже опубликовано: если что-то пойдет не так дальше,
+            # повтор задания поправит его, а не опубликует второе табло
+            job['edit_message_id'] = sent_message.message_id
+            try:
+                await self.bucket.acquire()
+                await self.telegram.pin_chat_message(
+                    chat_id=chat_id,
+                    message_id=sent_message.message_id,
+                    disable_notification=True
+                )
+            except TelegramError as e:
+                # Закрепление не обязательно: табло уже в канале
+                logger.warning(f"⚠️ Не удалось закрепить табло в канале {chat_id}: {e}")
+        return sent_message.message_id
+
+    def _retry(self, job, delay=None):
+        """Планирует повтор с экспоненциальной задержкой"""
+        job['attempts'] += 1
+        if job['attempts'] >= self.max_attempts:
+            self._fail(job, "превышено число попыток")
+            return
+        if delay is None:
+            delay = min(self.retry_max, self.retry_base * 2 ** (job['attempts'] - 1))
+        batch = self.batches.pop(job['id'], None)
+        if batch is not None:
+            batch.mark_deferred(job['chat_id'])
+        asyncio.get_running_loop().call_later(delay, self._enqueue, job)
+
+    def _fail(self, job, error, permanent=False):
+        self.outbox.drop(job)
+        batch = self.batches.pop(job['id'], None)
+        if batch is not None:
+            batch.mark_failed(job['chat_id'], error, permanent)
+        if self.on_failed:
+            self.on_failed(job['chat_id'], error, permanent, job)
+
+class ShardedBroadcaster(Broadcaster):
+    """Рассылка через несколько процессов доставки (broadcast_worker.py)
+
+    Каналы делятся между процессами консистентным хешированием chat_id, так
+    что сообщения и правки табло одного канала всегда идут через один
+    процесс. Общий лимит Telegram процессы делят через разделяемую память.
+    Журнал, отчеты о рассылке и колбэки остаются в процессе бота: он только
+    раскладывает задания по очередям процессов и разбирает их результаты.
+    """
+
+    def __init__(self, writer, shards=2, api_url=None, **kwargs):
+        super().__init__(writer, **kwargs)
+        self.shards = shards
+        self.api_url = api_url
+        self.ring = ConsistentHashRing(range(shards))
+        self.budget = None
+        self.processes = []
+        self.job_queues = []
+        self.results = None
+        self.inflight = {}
+
+    def _start_workers(self):
+        context = multiprocessing.get_context('spawn')
+        self.budget = SharedTokenBucket(self.bucket.rate, self.bucket.capacity, context=context)
+        self.results = context.Queue()
+        self.job_queues = [context.Queue() for _ in range(self.shards)]
+        api_url = self.api_url or self.telegram.base_url
+        options = {
+            'concurrency': self.workers,
+            'per_chat_interval': self.chat_limiter.interval,
+            'max_attempts': self.max_attempts,
+            'retry_base': self.retry_base,
+            'retry_max': self.retry_max,
+            'permanent_errors': PERMANENT_SEND_ERRORS
+        }
+        self.processes = [
+            context.Process(
+                target=run_worker,
+                args=(shard, api_url, self.job_queues[shard], self.results, self.budget, options),
+                name=f"broadcast-shard-{shard}",
+                daemon=True
+            )
+            for shard in range(self.shards)
+        ]
+        for process in self.processes:
+            process.start()
+        self.tasks = [asyncio.create_task(self._collect())]
+        logger.info(f"📮 Запущено {self.shards} процессов доставки по {self.workers} воркеров")
+
+    def _enqueue(self, job):
+        self.inflight[job['id']] = job
+        self.job_queues[self.ring.node_for(job['chat_id'])].put(job)
+
+    async def _collect(self):
+        """Разбирает результаты процессов доставки"""
+        loop = asyncio.get_running_loop()
+        while True:
+            result = await loop.run_in_executor(None, self.results.get)
+            if result is None:
+                return
+            kind, job_id = result[0], result[1]
+            if kind == 'deferred':
+                job = self.inflight.get(job_id)
+                batch = self.batches.pop(job_id, None)
+                if batch is not None and job is not None:
+                    batch.mark_deferred(job['chat_id'])
+                continue
+            job = self.inflight.pop(job_id, None)
+            if job is None:
+                continue
+            if kind == 'delivered':
+                self._delivered(job, result[2])
+            else:
+                logger.error(f"❌ Ошибка отправки в канал {job['chat_id']}: {result[2]}")
+                self._fail(job, result[2], result[3])
+
+    async def stop(self):
+        """Останавливает процессы доставки; недоставленное останется в журнале"""
+        for jobs in self.job_queues:
+            jobs.put(None)
+        if self.results is not None:
+            self.results.put(None)
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        loop = asyncio.get_running_loop()
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, 5)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        self.inflight.clear()
+
+    def describe(self):
+        alive = sum(1 for process in self.processes if process.is_alive())
+        sent = self.budget.acquired.value if self.budget is not None else 0
+        return (f"📮 Доставка: процессов {alive}/{self.shards}, в пути: {len(self.inflight)}, "
+                f"в журнале: {len(self.outbox.pending)}, запросов к API: {sent}")
+
+class LiveBoards:
+    """Живые табло: одно закрепленное сообщение на канал, которое правится
+
+    Обновления копятся coalesce_window сек. и уходят одной правкой; если
+    текст табло не изменился, правка не отправляется. Пока правка канала в
+    пути, следующая ждет ее завершения, поэтому правки одного канала не
+    обгоняют друг друга. ID сообщений хранятся в StateStore (ns 'boards').
+    """
+
+    def __init__(self, store, coalesce_window=3.0):
+        self.store = store
+        self.window = coalesce_window
+        self.boards = store.load('boards')
+        self.dirty = set()
+        self.in_flight = set()
+        self.flush_handle = None
+        self.flush_task = None
+        self.closed = False
+        self.render = None   # render(chat_id) -> текст табло
+        self.submit = None   # async submit(chat_id, text, message_id)
+        self.edits = 0
+        self.skipped = 0
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+    def touch(self, chat_ids):
+        """Отмечает табло каналов как требующие обновления"""
+        self.dirty.update(str(chat_id) for chat_id in chat_ids)
+        self._schedule()
+
+    def _schedule(self):
+        if self.flush_handle is None and self.dirty and not self.closed:
+            loop = asyncio.get_running_loop()
+            self.flush_handle = loop.call_later(self.window, self._start_flush)
+
+    def _start_flush(self):
+        self.flush_handle = None
+        self.flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    async def close(self):
+        """Останавливает обновления табло; вызывается до остановки рассылки"""
+        self.closed = True
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.flush_task is not None:
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+            self.flush_task = None
+
+    async def flush(self):
+        """Отправляет накопившиеся обновления табло"""
+        self.flush_handle = None
+        if self.closed:
+            return
+        ready = self.dirty - self.in_flight
+        self.dirty -= ready
+        for chat_id in ready:
+            try:
+                text = self.render(chat_id)
+                board = self.boards.get(chat_id) or {}
+                if board.get('message_id') and board.get('hash') == self.text_hash(text):
+                    self.skipped += 1
+                    continue
+                self.in_flight.add(chat_id)
+                await self.submit(chat_id, text, board.get('message_id'))
+            except Exception as e:
+                self.in_flight.discard(chat_id)
+                logger.error(f"❌ Ошибка обновления табло в канале {chat_id}: {e}")
+
+    def delivered(self, chat_id, message_id, text):
+        self.in_flight.discard(chat_id)
+        self.edits += 1
+        self.boards[chat_id] = {'message_id': message_id, 'hash': self.text_hash(text)}
+        self.store.put('boards', chat_id, self.boards[chat_id])
+        self._schedule()
+
+    def failed(self, chat_id):
+        self.in_flight.discard(chat_id)
+        self._schedule()
+
+    def forget(self, chat_id):
+        self.dirty.discard(str(chat_id))
+        if self.boards.pop(str(chat_id), None) is not None:
+            self.store.delete('boards', str(chat_id))
+
+    def describe(self):
+        return f"📋 Живых табло: {len(self.boards)}, правок: {self.edits}, пропущено без изменений: {self.skipped}"
+
+class StateStore:
+    """Хранилище состояния бота в SQLite в режиме WAL
+
+    Данные лежат в таблице ключ-значение, разбитой на пространства имен
+    (whitelist, approved_channels, ...). Каждое изменение - одна атомарная
+    транзакция над одной строкой. С synchronous=NORMAL коммиты не делают
+    fsync, WAL сбрасывается на диск пачками при checkpoint.
+    """
+
+    def __init__(self, filename=STATE_DB_FILE, writer=None):
+        self.filename = filename
+        self.writer = writer
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS kv ('
+            'ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+            'PRIMARY KEY (ns, key))'
+        )
+
+    def load(self, ns):
+        """Загружает пространство имен как словарь key -> value"""
+        with self.lock:
+            rows = self.conn.execute('SELECT key, value FROM kv WHERE ns = ? ORDER BY rowid', (ns,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def get(self, ns, key, default=None):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM kv WHERE ns = ? AND key = ?', (ns, key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _put_rows(self, ns, rows):
+        try:
+            with self.lock:
+                self.conn.execute('BEGIN')
+                try:
+                    self.conn.executemany(
+                        'INSERT INTO kv (ns, key, value) VALUES (?, ?, ?) '
+                        'ON CONFLICT (ns, key) DO UPDATE SET value = excluded.value',
+                        rows
+                    )
+                    self.conn.execute('COMMIT')
+                except Exception:
+                    self.conn.execute('ROLLBACK')
+                    raise
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка записи в {self.filename} ({ns}): {e}")
+            return False
+
+    def _delete(self, ns, key):
+        try:
+            with self.lock:
+                self.conn.execute('DELETE FROM kv WHERE ns = ? AND key = ?', (ns, key))
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка удаления из {self.filename} ({ns}): {e}")
+            return False
+
+    def put_many(self, ns, items):
+        """Записывает пары (key, value) одной транзакцией
+
+        С фоновым писателем запись только ставится в очередь (значения
+        сериализуются сразу, поэтому дальнейшие изменения их не затронут).
+        """
+        rows = [(ns, str(key), json.dumps(value, ensure_ascii=False)) for key, value in items]
+        if self.writer is None:
+            return self._put_rows(ns, rows)
+        self.writer.submit(('kv', ns) + tuple(row[1] for row in rows), self._put_rows, ns, rows)
+        return True
+
+    def put(self, ns, key, value):
+        return self.put_many(ns, [(key, value)])
+
+    def delete(self, ns, key):
+        if self.writer is None:
+            return self._delete(ns, str(key))
+        # Тот же ключ очереди, что и у put: побеждает последняя операция
+        self.writer.submit(('kv', ns, str(key)), self._delete, ns, str(key))
+        return True
+
+    def migrate_json(self, sources):
+        """Однократно переносит данные из старых JSON файлов
+
+        sources - словарь ns -> имя JSON файла. Списки превращаются в ключи
+        со значением True, словари переносятся как есть.
+        """
+        if self.get('meta', 'migrated_from_json'):
+            return False
+        migrated = []
+        for ns, filename in sources.items():
+            try:
+                with open(filename, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            items = [(key, True) for key in data] if isinstance(data, list) else list(data.items())
+            rows = [(ns, str(key), json.dumps(value, ensure_ascii=False)) for key, value in items]
+            if self._put_rows(ns, rows):
+                migrated.append(f"{filename} ({len(items)})")
+        self._put_rows('meta', [('meta', 'migrated_from_json', json.dumps(time.time()))])
+        if migrated:
+            logger.info(f"📦 Данные перенесены в {self.filename}: {', '.join(migrated)}")
+        return True
+
+    def close(self):
+        with self.lock:
+            try:
+                self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            finally:
+                self.conn.close()
+
+class BotMetrics:
+    """Счетчики и замеры бота в памяти с отложенным сбросом на диск
+
+    Счетчики меняются только из event loop, поэтому блокировки не нужны.
+    Изменение помечает данные грязными и (однократно) планирует сброс через
+    flush_delay секунд; сама запись идет через фонового писателя хранилища.
+    """
+
+    def __init__(self, store, values, flush_delay=15.0, latency_alpha=0.2):
+        self.store = store
+        self.values = values
+        self.flush_delay = flush_delay
+        self.latency_alpha = latency_alpha
+        self.timings = {}
+        self.channel_latency = {}
+        self._flush_handle = None
+        self._flush_task = None
+
+    def incr(self, name, amount=1):
+        """Увеличивает постоянный счетчик"""
+        self.values[name] = self.values.get(name, 0) + amount
+        self._mark_dirty()
+
+    def set(self, name, value):
+        """Устанавливает постоянное значение"""
+        self.values[name] = value
+        self._mark_dirty()
+
+    def get(self, name, default=0):
+        return self.values.get(name, default)
+
+    def observe(self, name, ms):
+        """Добавляет замер времени в миллисекундах (только в памяти)"""
+        count, total, worst = self.timings.get(name, (0, 0.0, 0.0))
+        self.timings[name] = (count + 1, total + ms, max(worst, ms))
+
+    def observe_channel_latency(self, channel_id, seconds):
+        """Скользящее среднее задержки доставки в канал"""
+        previous = self.channel_latency.get(channel_id)
+        if previous is None:
+            self.channel_latency[channel_id] = seconds
+        else:
+            self.channel_latency[channel_id] = previous + self.latency_alpha * (seconds - previous)
+
+    def _mark_dirty(self):
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне event loop: данные сохранятся при следующем сбросе или остановке
+            return
+        self._flush_handle = loop.call_later(self.flush_delay, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        """Ставит снимок счетчиков в очередь фонового писателя"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self.store.put_many('stats', list(self.values.items()))
+
+    def format_timings(self):
+        """Средние и максимальные замеры для /stats"""
+        if not self.timings:
+            return "⏱ Замеров еще нет"
+        parts = [
+            f"{name} {total / count:.1f}/{worst:.1f} мс"
+            for name, (count, total, worst) in sorted(self.timings.items())
+        ]
+        return "⏱ Среднее/макс.: " + ", ".join(parts)
+
+    def format_slowest_channels(self, limit=3):
+        """Каналы с наибольшей задержкой доставки"""
+        if not self.channel_latency:
+            return None
+        slowest = sorted(self.channel_latency.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return "🐢 Медленные каналы: " + ", ".join(f"{channel_id} {latency:.2f} сек." for channel_id, latency in slowest)
+
+class TrackedItemIndex:
+    """Индекс отслеживаемых предметов
+
+    Хранит frozenset канонических названий для проверки членства и таблицу
+    нормализованных вариантов (регистр, пробелы, множественное число,
+    псевдонимы) -> каноническое название. Поиск - O(1).
+    """
+
+    def __init__(self, items=(), aliases=ITEM_ALIASES):
+        self.alias_groups = {}
+        for group in aliases:
+            normalized = frozenset(self.normalize(name) for name in group)
+            for name in normalized:
+                self.alias_groups[name] = normalized
+        self.items = frozenset()
+        self.table = {}
+        self.display = {}
+        for item in items:
+            self.add(item)
+
+    @staticmethod
+    def normalize(name):
+        """Нижний регистр и одиночные пробелы"""
+        return ' '.join(str(name).lower().split())
+
+    # Окончания единственного числа на -s: cactus, hibiscus, grass, iris
+    SINGULAR_ENDINGS = ('ss', 'us', 'is')
+
+    @classmethod
+    def singular(cls, name):
+        """Единственное число для последнего слова (eggs -> egg, berries -> berry)
+
+        Слова, которые только выглядят как множественное число (cactus),
+        не меняются.
+        """
+        if name.endswith('ies') and len(name) > 4:
+            return name[:-3] + 'y'
+        if name.endswith('oes'):
+            return name[:-2]
+        if name.endswith('s') and not name.endswith(cls.SINGULAR_ENDINGS):
+            return name[:-1]
+        return name
+
+    def variants(self, canonical):
+        """Все написания, по которым находится предмет"""
+        names = {self.normalize(canonical)}
+        names |= self.alias_groups.get(self.normalize(canonical), frozenset())
+        result = set()
+        for name in names:
+            result.add(name)
+            result.add(self.singular(name))
+        return result
+
+    def add(self, canonical):
+        """Добавляет предмет в индекс без полной перестройки"""
+        self.items = self.items | {canonical}
+        self.display[canonical] = canonical.title()
+        for variant in self.variants(canonical):
+            self.table.setdefault(variant, canonical)
+
+    def remove(self, canonical):
+        """Удаляет предмет из индекса без полной перестройки"""
+        self.items = self.items - {canonical}
+        self.display.pop(canonical, None)
+        for variant in self.variants(canonical):
+            if self.table.get(variant) == canonical:
+                del self.table[variant]
+                # Вариант мог совпадать с другим отслеживаемым предметом
+                for other in self.items:
+                    if variant in self.variants(other):
+                        self.table[variant] = other
+                        break
+
+    def resolve(self, name):
+        """Каноническое название отслеживаемого предмета или None"""
+        normalized = self.normalize(name)
+        canonical = self.table.get(normalized)
+        if canonical is None:
+            canonical = self.table.get(self.singular(normalized))
+        return canonical
+
+    def display_name(self, canonical):
+        """Название для сообщений (вычисляется один раз при добавлении)"""
+        display = self.display.get(canonical)
+        return display if display is not None else canonical.title()
+
+    def __contains__(self, name):
+        return self.resolve(name) is not None
+
+    def __len__(self):
+        return len(self.items)
 
 class GardenStockBot:
     def __init__(self):
-        self.whitelist = self.load_json(WHITELIST_FILE, [])
-        self.approved_channels = self.load_json(APPROVED_CHANNELS_FILE, {})
-        self.pending_channels = self.load_json(PENDING_CHANNELS_FILE, {})
-        self.stats = self.load_json(STATS_FILE, {
+        self.writer = AsyncWriter()
+        self.store = StateStore(writer=self.writer)
+        self.store.migrate_json({
+            'whitelist': WHITELIST_FILE,
+            'approved_channels': APPROVED_CHANNELS_FILE,
+            'pending_channels': PENDING_CHANNELS_FILE,
+            'stats': STATS_FILE
+        })
+        self.whitelist = list(self.store.load('whitelist'))
+        self.approved_channels = self.store.load('approved_channels')
+        self.pending_channels = self.store.load('pending_channels')
+        self.stats = {
             'start_time': time.time(),
             'total_messages_sent': 0,
             'channels_approved': 0,
-            'restart_count': 0
-        })
+            'restart_count': 0,
+            **self.store.load('stats')
+        }
+        self.metrics = BotMetrics(self.store, self.stats)
         self.proctor_items = self.load_proctor_items()
-        self.last_stock = {}
+        self.tracked = TrackedItemIndex(self.proctor_items)
+        self.renderer = MessageRenderer(self.tracked.display_name)
+        self.debug_capture = DebugCapture.from_settings(self.writer, getattr(self, 'debug_capture_settings', {}))
+        self.diff_engine = StockDiffEngine()
+        self.last_events = []
+        self.history = StockHistory(self.writer)
+        self.analytics = StockAnalytics(self.history) if np is not None else None
         self.last_messages = {}
         self.stock_check_task = None
+        self.http = StockHttpClient(headers=STOCK_API_HEADERS)
+        # Детектор изменений: валидаторы HTTP кэша и хэш последнего тела ответа
+        self.stock_validators = {}
+        self.last_body_hash = None
+        self.last_parsed_stock = None
+        self.scheduler = RestockScheduler()
+        self.poller = PollerSupervisor()
+        self.last_fetch_error = None
+        self.last_good_stock = None
+        self.last_good_at = None
+        self.fetch_in_flight = None
+        shards = getattr(self, 'broadcast_shards', 0)
+        if shards > 0:
+            self.broadcaster = ShardedBroadcaster(self.writer, shards=shards)
+        else:
+            self.broadcaster = Broadcaster(self.writer)
+        self.broadcaster.on_delivered = self.on_message_delivered
+        self.broadcaster.on_failed = self.on_message_failed
+        self.router = SubscriptionRouter(self.approved_channels)
+        self.application = None
+        self.boards = LiveBoards(self.store)
+        self.boards.render = self.render_board
+        self.boards.submit = self.submit_board
+        self.coalescer = EventCoalescer(
+            self.emit_stock_updates,
+            getattr(self, 'coalesce_window', 8),
+            snapshot=lambda: self.diff_engine.previous
+        )
+        self.last_broadcast_report = None
+        self.broadcast_tasks = set()
+        self.dedup_salt = b''
+        self.snapshot_restored_at = None
+        self.restore_stock_snapshot()
 
     def load_json(self, filename, default):
         """Загружает данные из JSON файла"""
@@ -62,15 +2579,14 @@ class GardenStockBot:
         except (FileNotFoundError, json.JSONDecodeError):
             return default
 
-    def save_json(self, filename, data):
-        """Сохраняет данные в JSON файл"""
-        try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка сохранения {filename}: {e}")
-            return False
+    def save_json(self, filename, data, indent=2):
+        """Сохраняет данные в JSON файл в фоновом потоке
+
+        Повторные сохранения того же файла, пока запись еще в очереди,
+        объединяются - на диск попадет последняя версия.
+        """
+        self.writer.submit(filename, write_json_file, filename, data, indent)
+        return True
 
     def load_proctor_items(self):
         """Загружает список отслеживаемых предметов из JSON"""
@@ -81,6 +2597,10 @@ class GardenStockBot:
                 
                 items = proctor_data.get('tracked_items', [])
                 self.check_interval = proctor_data.get('settings', {}).get('check_interval', 30)
+                self.debug_capture_settings = proctor_data.get('settings', {}).get('debug_capture', {})
+                self.snapshot_ttl = proctor_data.get('settings', {}).get('snapshot_ttl', 15)
+                self.coalesce_window = proctor_data.get('settings', {}).get('coalesce_window', 8)
+                self.broadcast_shards = proctor_data.get('settings', {}).get('broadcast_shards', 0)
                 
                 logger.info(f"🎯 Загружено {len(items)} предметов из proctor.json")
                 logger.info(f"⏰ Интервал проверки: {self.check_interval} сек.")
@@ -105,7 +2625,11 @@ class GardenStockBot:
                     "settings": {
                         "check_interval": 30,
                         "notify_all_items": False,
-                        "min_quantity": 1
+                        "min_quantity": 1,
+                        "snapshot_ttl": 15,
+                        "coalesce_window": 8,
+                        "broadcast_shards": 0,
+                        "debug_capture": {"mode": "off"}
                     },
                     "metadata": {
                         "last_updated": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
@@ -131,12 +2655,17 @@ class GardenStockBot:
             if items is None:
                 items = self.proctor_items
             
+            # Список копируется: файл пишется в фоне, а proctor_items может измениться
             proctor_data = {
-                "tracked_items": items,
+                "tracked_items": list(items),
                 "settings": {
                     "check_interval": getattr(self, 'check_interval', 30),
                     "notify_all_items": False,
-                    "min_quantity": 1
+                    "min_quantity": 1,
+                    "snapshot_ttl": getattr(self, 'snapshot_ttl', 15),
+                    "coalesce_window": self.coalescer.window,
+                    "broadcast_shards": getattr(self, 'broadcast_shards', 0),
+                    "debug_capture": self.debug_capture.settings()
                 },
                 "metadata": {
                     "last_updated": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
@@ -144,8 +2673,7 @@ class GardenStockBot:
                 }
             }
             
-            with open(PROCTOR_FILE, 'w', encoding='utf-8') as f:
-                json.dump(proctor_data, f, ensure_ascii=False, indent=2)
+            self.save_json(PROCTOR_FILE, proctor_data)
             
             logger.info(f"💾 Сохранено {len(items)} предметов в proctor.json")
             return True
@@ -154,6 +2682,26 @@ class GardenStockBot:
             logger.error(f"❌ Ошибка сохранения proctor.json: {e}")
             return False
 
+    def add_tracked_item(self, item_name):
+        """Добавляет предмет для отслеживания; None, если уже отслеживается"""
+        if item_name in self.tracked:
+            return None
+        self.proctor_items.append(item_name)
+        self.tracked.add(item_name)
+        # Разобранный снимок построен по старому набору предметов
+        self.reset_change_detector()
+        return self.save_proctor_items()
+
+    def remove_tracked_item(self, item_name):
+        """Удаляет предмет из отслеживания; None, если не найден"""
+        canonical = self.tracked.resolve(item_name)
+        if canonical is None:
+            return None
+        self.proctor_items.remove(canonical)
+        self.tracked.remove(canonical)
+        self.reset_change_detector()
+        return self.save_proctor_items()
+
     def is_whitelisted(self, user_id):
         """Проверяет, есть ли пользователь в белом списке"""
         return str(user_id) in self.whitelist
@@ -163,7 +2711,7 @@ class GardenStockBot:
         user_id_str = str(user_id)
         if user_id_str not in self.whitelist:
             self.whitelist.append(user_id_str)
-            if self.save_json(WHITELIST_FILE, self.whitelist):
+            if self.store.put('whitelist', user_id_str, True):
                 logger.info(f"✅ Добавлен в белый список: {user_id_str} ({username})")
                 return True
         return False
@@ -173,7 +2721,7 @@ class GardenStockBot:
         user_id_str = str(user_id)
         if user_id_str in self.whitelist:
             self.whitelist.remove(user_id_str)
-            if self.save_json(WHITELIST_FILE, self.whitelist):
+            if self.store.delete('whitelist', user_id_str):
                 logger.info(f"❌ Удален из белого списка: {user_id_str}")
                 return True
         return False
@@ -186,89 +2734,393 @@ class GardenStockBot:
             'request_time': time.time(),
             'invite_link': invite_link
         }
-        if self.save_json(PENDING_CHANNELS_FILE, self.pending_channels):
+        if self.store.put('pending_channels', str(channel_id), self.pending_channels[str(channel_id)]):
             logger.info(f"⏳ Канал в ожидании: {channel_title} (ID: {channel_id})")
             return True
         return False
 
-    def remove_pending_channel(self, channel_id):
-        """Удаляет канал из ожидания"""
+    def remove_pending_channel(self, channel_id):
+        """Удаляет канал из ожидания"""
+        channel_id_str = str(channel_id)
+        if channel_id_str in self.pending_channels:
+            del self.pending_channels[channel_id_str]
+            if self.store.delete('pending_channels', channel_id_str):
+                logger.info(f"🗑️ Удален из ожидания: {channel_id_str}")
+                return True
+        return False
+
+    def add_approved_channel(self, channel_id, channel_title, approved_by):
+        """Добавляет одобренный канал"""
+        self.approved_channels[str(channel_id)] = {
+            'title': channel_title,
+            'approved_at': time.time(),
+            'approved_by': approved_by
+        }
+        self.metrics.set('channels_approved', len(self.approved_channels))
+        self.router.rebuild(self.approved_channels)
+        if self.store.put('approved_channels', str(channel_id), self.approved_channels[str(channel_id)]):
+            logger.info(f"✅ Канал одобрен: {channel_title} (ID: {channel_id})")
+            return True
+        return False
+
+    def remove_approved_channel(self, channel_id):
+        """Удаляет одобренный канал"""
+        channel_id_str = str(channel_id)
+        if channel_id_str in self.approved_channels:
+            del self.approved_channels[channel_id_str]
+            self.metrics.set('channels_approved', len(self.approved_channels))
+            self.router.rebuild(self.approved_channels)
+            self.boards.forget(channel_id_str)
+            if self.store.delete('approved_channels', channel_id_str):
+                logger.info(f"❌ Канал удален: {channel_id_str}")
+                return True
+        return False
+
+    def set_channel_subscription(self, channel_id, subscription):
+        """Устанавливает подписку канала (None - все отслеживаемые предметы)"""
+        channel_id_str = str(channel_id)
+        if channel_id_str not in self.approved_channels:
+            return False
+        if subscription and (subscription.get('items') or subscription.get('categories')
+                             or subscription.get('min_quantity', 1) > 1):
+            self.approved_channels[channel_id_str]['subscription'] = subscription
+        else:
+            self.approved_channels[channel_id_str].pop('subscription', None)
+        self.router.rebuild(self.approved_channels)
+        if self.store.put('approved_channels', channel_id_str, self.approved_channels[channel_id_str]):
+            logger.info(f"🔖 Подписка канала {channel_id_str}: {subscription or 'все предметы'}")
+            return True
+        return False
+
+    def set_channel_locale(self, channel_id, locale):
+        """Устанавливает язык сообщений канала"""
+        channel_id_str = str(channel_id)
+        if channel_id_str not in self.approved_channels or locale not in MESSAGE_TEMPLATES:
+            return False
+        self.approved_channels[channel_id_str]['locale'] = locale
+        if self.store.put('approved_channels', channel_id_str, self.approved_channels[channel_id_str]):
+            logger.info(f"🌐 Язык канала {channel_id_str}: {locale}")
+            return True
+        return False
+
+    def set_channel_board(self, channel_id, enabled):
+        """Включает или выключает живое табло канала"""
+        channel_id_str = str(channel_id)
+        if channel_id_str not in self.approved_channels:
+            return False
+        if enabled:
+            self.approved_channels[channel_id_str]['board'] = True
+        else:
+            self.approved_channels[channel_id_str].pop('board', None)
+            self.boards.forget(channel_id_str)
+        if self.store.put('approved_channels', channel_id_str, self.approved_channels[channel_id_str]):
+            logger.info(f"📋 Живое табло канала {channel_id_str}: {'включено' if enabled else 'выключено'}")
+            return True
+        return False
+
+    def board_channels(self):
+        return [channel_id for channel_id, channel_info in self.approved_channels.items() if channel_info.get('board')]
+
+    def render_board(self, channel_id):
+        """Текст живого табло канала по текущему снимку и подписке
+
+        Время в текст не входит (Telegram сам показывает правку), поэтому
+        неизменившийся сток дает байт-в-байт тот же текст.
+        """
+        channel_info = self.approved_channels.get(str(channel_id), {})
+        items, categories, min_quantity = SubscriptionRouter.subscription(channel_info)
+        everything = not items and not categories
+        entries = []
+        for category in STOCK_CATEGORIES:
+            category_items = tuple(sorted(
+                (name, quantity) for name, quantity in self.diff_engine.previous.get(category, {}).items()
+                if quantity >= min_quantity and (everything or name in items or category in categories)
+            ))
+            if category_items:
+                entries.append((category, category_items))
+        return self.renderer.board(entries, channel_info.get('locale', DEFAULT_LOCALE))
+
+    async def submit_board(self, channel_id, text, message_id):
+        """Ставит правку табло в очередь рассылки"""
+        priority = self.approved_channels.get(channel_id, {}).get('priority', 0)
+        await self.broadcaster.update_board(self.application.bot, channel_id, text, message_id, priority)
+
+    def describe_subscription(self, channel_id):
+        """Текстовое описание подписки канала"""
+        items, categories, min_quantity = SubscriptionRouter.subscription(self.approved_channels.get(str(channel_id), {}))
+        if not items and not categories:
+            text = "все отслеживаемые предметы"
+        else:
+            parts = []
+            if items:
+                parts.append(f"предметы: {', '.join(sorted(items))}")
+            if categories:
+                parts.append(f"категории: {', '.join(sorted(categories))}")
+            text = '; '.join(parts)
+        if min_quantity > 1:
+            text += f"; от {min_quantity} шт."
+        return text
+
+    def conditional_headers(self):
+        """Заголовки условного запроса по сохраненным ETag / Last-Modified"""
+        headers = {}
+        if self.last_parsed_stock is None:
+            return headers
+        if self.stock_validators.get('etag'):
+            headers['If-None-Match'] = self.stock_validators['etag']
+        if self.stock_validators.get('last_modified'):
+            headers['If-Modified-Since'] = self.stock_validators['last_modified']
+        return headers
+
+    async def fetch_stock(self):
+        """Получает снимок стока по категориям и сообщает, изменился ли он: (snapshot, changed)
+
+        Запрос идет через предохранитель: пока он открыт, сразу возвращается
+        (None, False) без ожидания сети. Успешный снимок запоминается как
+        последний хороший для чтения без сети (cached_stock).
+        """
+        if not self.poller.allow_request():
+            self.last_fetch_error = "предохранитель открыт"
+            return None, False
+            
+        stock, changed = await self._request_stock()
+        if stock is None:
+            if self.poller.record_failure(self.last_fetch_error):
+                # Начинаем с чистого листа: новые соединения и повторный разбор.
+                # Снимок стока остается, иначе все предметы ушли бы в каналы как новые
+                self.reset_change_detector()
+                await self.http.close()
+        else:
+            self.poller.record_success()
+            self.last_good_stock = stock
+            self.last_good_at = time.time()
+        return stock, changed
+
+    async def get_stock(self, max_age=None, timeout=None):
+        """Снимок стока через общий кэш (single-flight)
+
+        Снимок не старше max_age сек. (по умолчанию snapshot_ttl из
+        настроек) отдается из кэша без запроса. Иначе вызывающий
+        присоединяется к уже идущему запросу или начинает новый, так что
+        к API одновременно идет не больше одного запроса. Возвращает None,
+        если получить сток не удалось или запрос не уложился в timeout сек.
+        (сам запрос при этом продолжается).
+        """
+        max_age = getattr(self, 'snapshot_ttl', 15) if max_age is None else max_age
+        stock, age = self.cached_stock()
+        if stock is not None and age <= max_age:
+            self.metrics.incr('snapshot_cache_hits')
+            return stock
+        # shield: отмена одного из ожидающих не отменяет общий запрос
+        fetch = asyncio.shield(self.start_shared_fetch())
+        try:
+            stock, _ = await (fetch if timeout is None else asyncio.wait_for(fetch, timeout))
+        except asyncio.TimeoutError:
+            self.metrics.incr('snapshot_fetch_timeouts')
+            return None
+        return stock
+
+    def start_shared_fetch(self):
+        """Запускает общий запрос к API или возвращает уже идущий"""
+        if self.fetch_in_flight is None:
+            self.fetch_in_flight = asyncio.ensure_future(self._shared_fetch())
+        else:
+            self.metrics.incr('snapshot_fetch_joins')
+        return self.fetch_in_flight
+
+    async def _shared_fetch(self):
+        try:
+            return await self.fetch_stock()
+        finally:
+            self.fetch_in_flight = None
+
+    def cached_stock(self):
+        """Последний хороший снимок и его возраст в секундах: (snapshot, age) или (None, None)"""
+        if self.last_good_stock is None:
+            return None, None
+        return self.last_good_stock, time.time() - self.last_good_at
+
+    async def _request_stock(self):
+        """Запрос к API и разбор ответа: (snapshot, changed)
+
+        При 304 или совпадении хэша тела парсинг пропускается и возвращается
+        предыдущий результат. При ошибке возвращается (None, False).
+        """
+        try:
+            status, response_headers, body = await self.http.get(STOCK_API_URL, self.conditional_headers())
+        except asyncio.TimeoutError:
+            logger.error("❌ Таймаут при запросе к API")
+            self.last_fetch_error = "таймаут"
+            self.debug_capture.observe(None)
+            return None, False
+        except Exception as e:
+            logger.error(f"❌ Ошибка получения стока: {e}")
+            self.last_fetch_error = str(e) or type(e).__name__
+            self.debug_capture.observe(None)
+            return None, False
+
+        if status == 304 and self.last_parsed_stock is not None:
+            self.metrics.incr('polls_unchanged')
+            # Тело не пришло, но оно то же, что в прошлый раз
+            self.debug_capture.observe(self.debug_capture.last_body)
+            return self.last_parsed_stock, False
+
+        if status != 200:
+            logger.error(f"❌ Ошибка API: {status}")
+            self.last_fetch_error = f"HTTP {status}"
+            self.debug_capture.observe(None)
+            return None, False
+
+        self.stock_validators = {
+            'etag': response_headers.get('ETag'),
+            'last_modified': response_headers.get('Last-Modified')
+        }
+
+        body_hash = hashlib.blake2b(body, digest_size=16).digest()
+        if body_hash == self.last_body_hash and self.last_parsed_stock is not None:
+            self.metrics.incr('polls_unchanged')
+            self.debug_capture.observe(body)
+            return self.last_parsed_stock, False
+
+        try:
+            raw_data = decode_stock_payload(body)
+            logger.info(f"✅ Успешно получены сырые данные API")
+            self.scheduler.update_timers(raw_data.get('restockTimers'))
+            
+            # Полное форматирование (format_stocks) нужно только для отладки -
+            # для уведомлений достаточно однопроходного извлечения
+            parse_started = time.perf_counter()
+            stock = extract_tracked_stock(raw_data, self.tracked)
+            self.metrics.observe('parse', (time.perf_counter() - parse_started) * 1000)
+            logger.info(f"📊 Найдено {sum(len(items) for items in stock.values())} отслеживаемых предметов в стоке")
+        except Exception as e:
+            logger.error(f"❌ Ошибка разбора ответа API: {e}")
+            self.last_fetch_error = f"ошибка разбора: {e}"
+            self.metrics.incr('parse_errors')
+            self.debug_capture.observe(body, error=True)
+            return None, False
+
+        self.debug_capture.observe(body, changed=True)
+
+        # Хэш запоминаем только после успешного разбора, чтобы повторить попытку
+        self.last_body_hash = body_hash
+        self.last_parsed_stock = stock
+        return stock, True
+
+    def reset_change_detector(self):
+        """Сбрасывает детектор изменений: следующий ответ API будет разобран заново"""
+        self.last_body_hash = None
+        self.last_parsed_stock = None
+        self.stock_validators = {}
+
+    def reset_stock_memory(self):
+        """Сбрасывает память о стоке вместе с детектором изменений и сохраненным снимком"""
+        self.diff_engine.reset()
+        self.reset_change_detector()
+        # Новая соль ключей: тот же сток после сброса не считается повтором в журнале
+        self.dedup_salt = os.urandom(8)
+        self.snapshot_restored_at = None
+        self.store.delete('stock', 'last_snapshot')
+
+    def save_stock_snapshot(self, snapshot):
+        """Сохраняет последний снимок стока с версией, временем и таймерами рестока
+
+        Пустые категории не пишутся. Запись идет через фоновый писатель,
+        частые сохранения объединяются.
+        """
+        record = {
+            'version': STOCK_SNAPSHOT_VERSION,
+            'timestamp': int(time.time()),
+            'snapshot': {category: items for category, items in snapshot.items() if items},
+            'timers': dict(self.scheduler.last_deadline)
+        }
+        return self.store.put('stock', 'last_snapshot', record)
+
+    def restore_stock_snapshot(self):
+        """Загружает сохраненный снимок стока в детектор изменений
+
+        Первый опрос после перезапуска сравнивается с этим снимком, поэтому
+        в каналы уходят только реальные изменения. Таймеры рестока тоже
+        восстанавливаются: если рестокинг прошел, пока бот был выключен,
+        первый опрос это заметит.
+        """
+        record = self.store.get('stock', 'last_snapshot')
+        if not isinstance(record, dict):
+            return False
+        if record.get('version') != STOCK_SNAPSHOT_VERSION:
+            logger.warning(f"⚠️ Снимок стока версии {record.get('version')} не поддерживается, пропускаем")
+            return False
+
+        snapshot = {}
+        for category, items in (record.get('snapshot') or {}).items():
+            if category not in STOCK_CATEGORIES or not isinstance(items, dict):
+                continue
+            # Предметы, которые перестали отслеживать, в сравнении не участвуют
+            snapshot[category] = {
+                name: quantity for name, quantity in items.items()
+                if name in self.tracked.items and isinstance(quantity, int)
+            }
+        self.diff_engine.reset(snapshot)
+        for category, deadline in (record.get('timers') or {}).items():
+            if isinstance(deadline, (int, float)):
+                self.scheduler.deadlines.setdefault(category, deadline)
+                self.scheduler.last_deadline.setdefault(category, deadline)
+
+        self.snapshot_restored_at = record.get('timestamp') or time.time()
+        # До первого успешного опроса команды показывают сохраненный снимок
+        self.last_good_stock = snapshot
+        self.last_good_at = self.snapshot_restored_at
+        age = max(0, time.time() - self.snapshot_restored_at)
+        logger.info(
+            f"♻️ Восстановлен снимок стока: {sum(len(items) for items in snapshot.values())} предметов, "
+            f"возраст {int(age)} сек."
+        )
+        return True
+
+    def set_channel_priority(self, channel_id, priority):
+        """Устанавливает приоритет канала (больше - раньше в рассылке)"""
         channel_id_str = str(channel_id)
-        if channel_id_str in self.pending_channels:
-            del self.pending_channels[channel_id_str]
-            if self.save_json(PENDING_CHANNELS_FILE, self.pending_channels):
-                logger.info(f"🗑️ Удален из ожидания: {channel_id_str}")
-                return True
-        return False
-
-    def add_approved_channel(self, channel_id, channel_title, approved_by):
-        """Добавляет одобренный канал"""
-        self.approved_channels[str(channel_id)] = {
-            'title': channel_title,
-            'approved_at': time.time(),
-            'approved_by': approved_by
-        }
-        self.stats['channels_approved'] = len(self.approved_channels)
-        if self.save_json(APPROVED_CHANNELS_FILE, self.approved_channels):
-            self.save_json(STATS_FILE, self.stats)
-            logger.info(f"✅ Канал одобрен: {channel_title} (ID: {channel_id})")
+        if channel_id_str not in self.approved_channels:
+            return False
+        self.approved_channels[channel_id_str]['priority'] = priority
+        if self.store.put('approved_channels', channel_id_str, self.approved_channels[channel_id_str]):
+            logger.info(f"📶 Приоритет канала {channel_id_str}: {priority}")
             return True
         return False
 
-    def remove_approved_channel(self, channel_id):
-        """Удаляет одобренный канал"""
-        channel_id_str = str(channel_id)
-        if channel_id_str in self.approved_channels:
-            del self.approved_channels[channel_id_str]
-            self.stats['channels_approved'] = len(self.approved_channels)
-            if self.save_json(APPROVED_CHANNELS_FILE, self.approved_channels):
-                self.save_json(STATS_FILE, self.stats)
-                logger.info(f"❌ Канал удален: {channel_id_str}")
-                return True
-        return False
+    def restock_cycles(self):
+        """Периоды и ближайшие дедлайны рестока по категориям: {категория: (период, дедлайн)}"""
+        cycles = {category: (period, None) for category, period in DEFAULT_RESTOCK_PERIODS.items()}
+        for key, deadline in self.scheduler.deadlines.items():
+            category = timer_category(key)
+            if category is not None:
+                period = self.scheduler.periods.get(key, cycles.get(category, (None, None))[0])
+                cycles[category] = (period, deadline)
+        for key, period in self.scheduler.periods.items():
+            category = timer_category(key)
+            if category is not None and category not in cycles:
+                cycles[category] = (period, None)
+        return cycles
 
     async def get_real_garden_stock(self):
-        """Get real stock data from Grow A Garden API - NEW VERSION"""
-        
-        headers = {
-            'accept': '*/*',
-            'accept-language': 'en-US,en;q=0.9',
-            'content-type': 'application/json',
-            'priority': 'u=1, i',
-            'referer': 'https://growagarden.gg/stocks',
-            'trpc-accept': 'application/json',
-            'x-trpc-source': 'gag',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-        
-        try:
-            timeout = aiohttp.ClientTimeout(total=15)
-            async with aiohttp.ClientSession(headers=headers, timeout=timeout) as session:
-                async with session.get('https://growagarden.gg/api/stock') as response:
-                    if response.status == 200:
-                        raw_data = await response.json()
-                        logger.info(f"✅ Успешно получены сырые данные API")
-                        
-                        # Сохраняем сырые данные для отладки
-                        try:
-                            with open('debug_stock_raw.json', 'w', encoding='utf-8') as f:
-                                json.dump(raw_data, f, indent=2, ensure_ascii=False)
-                            logger.info("💾 Сырые данные сохранены в debug_stock_raw.json")
-                        except:
-                            pass
-                        
-                        # Форматируем данные как в JavaScript коде
-                        formatted_data = self.format_stocks(raw_data)
-                        return self.parse_formatted_stock_data(formatted_data)
-                    else:
-                        logger.error(f"❌ Ошибка API: {response.status}")
-                        return {}
-        except asyncio.TimeoutError:
-            logger.error("❌ Таймаут при запросе к API")
-            return {}
-        except Exception as e:
-            logger.error(f"❌ Ошибка получения стока: {e}")
-            return {}
+        """Сток для чтения (команды): {предмет: количество} и возраст данных в секундах
+
+        Пока API отвечает нормально, снимок берется из общего кэша (не старше
+        snapshot_ttl). Устаревший снимок отдается сразу с его возрастом, а
+        свежий запрашивается в фоне. Без снимка живой запрос ждем не дольше
+        STOCK_READ_TIMEOUT. Если опрос в ошибках или запрос не удался, тоже
+        сразу отдается последний хороший снимок, без ожидания сети.
+        """
+        if self.poller.state == PollerSupervisor.HEALTHY:
+            stock, age = self.cached_stock()
+            if stock is not None and age > getattr(self, 'snapshot_ttl', 15):
+                self.start_shared_fetch()
+                return flatten_stock(stock), age
+            stock = await self.get_stock(timeout=STOCK_READ_TIMEOUT)
+            if stock is not None:
+                return flatten_stock(stock), self.cached_stock()[1]
+        stock, age = self.cached_stock()
+        return flatten_stock(stock or {}), age
 
     def format_items(self, items, image_data=None, is_last_seen=False):
         """Форматирует items как в JavaScript коде"""
@@ -330,14 +3182,6 @@ class GardenStockBot:
             
             'restockTimers': stocks_data.get('restockTimers', {})
         }
-        
-        # Сохраняем отформатированные данные для отладки
-        try:
-            with open('debug_stock_formatted.json', 'w', encoding='utf-8') as f:
-                json.dump(formatted, f, indent=2, ensure_ascii=False)
-            logger.info("💾 Отформатированные данные сохранены в debug_stock_formatted.json")
-        except:
-            pass
             
         return formatted
 
@@ -349,15 +3193,7 @@ class GardenStockBot:
             logger.info(f"🔍 Начинаем парсинг отформатированных данных")
             
             # Основные категории стоков
-            stock_categories = [
-                'easterStock',      # Пасхальный сток
-                'gearStock',        # Инструменты
-                'eggStock',         # Яйца
-                'nightStock',       # Ночной магазин
-                'honeyStock',       # Мед
-                'cosmeticsStock',   # Косметика
-                'seedsStock'        # Семена
-            ]
+            stock_categories = STOCK_CATEGORIES
             
             total_found = 0
             
@@ -377,29 +3213,23 @@ class GardenStockBot:
                             if not name:
                                 continue
                                 
-                            name = str(name).lower().strip()
+                            canonical = self.tracked.resolve(name)
+                            if canonical is None:
+                                continue
                             
                             # Получаем количество (value в отформатированных данных)
                             quantity = item.get('value')
                             if quantity is None:
                                 continue
                                 
-                            if isinstance(quantity, str):
-                                try:
-                                    quantity = int(quantity)
-                                except ValueError:
-                                    quantity = 0
-                            elif isinstance(quantity, (int, float)):
-                                quantity = int(quantity)
-                            else:
-                                quantity = 0
+                            quantity = stock_quantity(quantity)
                             
                             # Проверяем, отслеживается ли предмет и есть ли в наличии
-                            if name in self.proctor_items and quantity > 0:
-                                stock_items[name] = quantity
+                            if quantity > 0:
+                                stock_items[canonical] = quantity
                                 category_found += 1
                                 total_found += 1
-                                logger.info(f"🎯 Найден в {category}: {name} - {quantity} шт.")
+                                logger.info(f"🎯 Найден в {category}: {canonical} - {quantity} шт.")
                                 
                         except Exception as e:
                             logger.warning(f"⚠️ Ошибка обработки элемента в {category}: {e}")
@@ -422,152 +3252,207 @@ class GardenStockBot:
             logger.error(f"❌ Ошибка парсинга отформатированных данных: {e}")
             return {}
 
-    def format_stock_message(self, new_items):
-        """Форматирует красивое сообщение о стоке"""
-        if not new_items:
-            return None
+    def format_stock_message(self, events, locale=DEFAULT_LOCALE, stamp=None):
+        """Форматирует красивое сообщение о стоке по событиям"""
+        return self.renderer.stock_message(events, locale, stamp)
+
+    def on_message_delivered(self, channel_id, message_id, job=None):
+        """Колбэк воркера рассылки: сообщение доставлено"""
+        if job and job.get('board'):
+            self.boards.delivered(str(channel_id), message_id, job['text'])
+            self.metrics.incr('board_updates')
+            return
+        self.last_messages[str(channel_id)] = message_id
+        self.metrics.incr('total_messages_sent')
+
+    def on_message_failed(self, channel_id, error, permanent, job=None):
+        """Колбэк воркера рассылки: сообщение не доставлено"""
+        self.metrics.incr('send_failures')
+        if job and job.get('board'):
+            self.boards.failed(str(channel_id))
+        if permanent:
+            logger.warning(f"🗑️ Удаляем канал {channel_id} из одобренных")
+            self.remove_approved_channel(channel_id)
+
+    def snapshot_key(self, events):
+        """Ключ снимка стока для дедупликации рассылок"""
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(self.dedup_salt)
+        digest.update(self.last_body_hash or b'')
+        digest.update(json.dumps(sorted(events), ensure_ascii=False).encode('utf-8'))
+        return digest.hexdigest()
+
+    async def emit_stock_updates(self, events):
+        """Рассылает пачку событий из EventCoalescer и сохраняет снимок стока
+
+        Снимок сохраняется только после постановки рассылки в журнал: при
+        сбое, пока события копились, они будут найдены и отправлены заново.
+        """
+        await self.send_stock_updates(self.application, events)
+        if not self.coalescer.pending:
+            self.save_stock_snapshot(self.diff_engine.previous)
+
+    async def send_stock_updates(self, application, events):
+        """Отправляет обновления в одобренные каналы по их подпискам"""
+        if not events:
+            logger.info("ℹ️ Нет новых предметов для отправки")
+            return
             
-        if len(new_items) == 1:
-            title = "🎯 *НОВЫЙ ПРЕДМЕТ В СТОКЕ!*\n\n"
-        else:
-            title = f"🎯 *НОВЫЕ ПРЕДМЕТЫ В СТОКЕ!* ({len(new_items)} шт.)\n\n"
+        # Каналы с одинаковым набором событий и языком получают один и тот же текст из кэша рендера
+        stamp = datetime.now().strftime('%H:%M:%S')
+        messages = set()
+        deliveries = []
+        for channel_id, channel_events in self.router.route(events).items():
+            channel_info = self.approved_channels.get(channel_id, {})
+            if channel_info.get('board'):
+                # Каналы с живым табло получают правку табло, а не новое сообщение
+                continue
+            message = self.format_stock_message(channel_events, channel_info.get('locale', DEFAULT_LOCALE), stamp)
+            messages.add(id(message))
+            deliveries.append((channel_info.get('priority', 0), channel_id, message))
+        
+        if not deliveries:
+            logger.info("ℹ️ Нет каналов, подписанных на эти события")
+            return
         
-        items_text = ""
-        for item_name, quantity in new_items.items():
-            display_name = item_name.title()
-            items_text += f"🟢 *{display_name}* — `{quantity}` шт.\n"
+        logger.info(f"📨 Начинаем отправку в {len(deliveries)} каналов (вариантов сообщения: {len(messages)})")
         
-        message = f"{title}{items_text}\n⏰ *Обновлено:* {datetime.now().strftime('%H:%M:%S')}\n\n🔔 *Garden Stock Bot*"
-        return message
+        batch = await self.broadcaster.broadcast(application.bot, deliveries, self.snapshot_key(events))
+        # Рассылка уже в журнале; опрос не ждет доставки, итог собирает отдельная задача
+        task = asyncio.create_task(self.finish_broadcast(batch))
+        self.broadcast_tasks.add(task)
+        task.add_done_callback(self.broadcast_tasks.discard)
 
-    def find_new_items(self, current_stock):
-        """Находит новые предметы по сравнению с предыдущей проверкой"""
-        new_items = {}
+    async def finish_broadcast(self, batch):
+        """Ждет первой попытки доставки во все каналы и записывает итог рассылки"""
+        await batch.done.wait()
+        report = batch.report()
+        self.last_broadcast_report = report
         
-        logger.info(f"🔍 Поиск новых предметов. Текущий сток: {len(current_stock)} предметов")
-        logger.info(f"📋 Текущие предметы: {list(current_stock.keys())}")
-        logger.info(f"📋 Предыдущий сток: {list(self.last_stock.keys())}")
+        if report['duplicates']:
+            logger.info(f"♻️ Пропущено {report['duplicates']} повторных отправок того же стока")
         
-        for item_name, quantity in current_stock.items():
-            if item_name not in self.last_stock:
-                new_items[item_name] = quantity
-                logger.info(f"🆕 НОВЫЙ ПРЕДМЕТ ОБНАРУЖЕН: {item_name} - {quantity} шт.")
-            else:
-                logger.info(f"🔁 Предмет уже был: {item_name} - {quantity} шт.")
-                
-        self.last_stock = current_stock.copy()
+        self.metrics.incr('broadcasts')
+        for channel_id, latency in report['latencies'].items():
+            self.metrics.observe_channel_latency(channel_id, latency)
         
-        logger.info(f"🎯 ИТОГО новых предметов: {len(new_items)}")
-        return new_items
+        sent_count = len(report['delivered'])
+        if sent_count > 0:
+            logger.info(
+                f"📊 Итог отправки: {sent_count} успешно, {len(report['failed'])} неудачно, "
+                f"{len(report['deferred'])} отложено на повтор"
+            )
+            logger.info(
+                f"⏱ Задержка доставки: первая {report['first']:.2f} сек., p50 {report['p50']:.2f} сек., "
+                f"p95 {report['p95']:.2f} сек., последняя {report['last']:.2f} сек."
+            )
 
-    async def send_stock_updates(self, application, new_items):
-        """Отправляет обновления во все одобренные каналы"""
-        if not new_items:
-            logger.info("ℹ️ Нет новых предметов для отправки")
-            return
+    def format_broadcast_report(self):
+        """Описание последней рассылки для /stats"""
+        report = self.last_broadcast_report
+        if not report:
+            return "📨 Рассылок еще не было"
+        return (
+            f"📨 Последняя рассылка: {len(report['delivered'])} доставлено, {len(report['failed'])} ошибок, "
+            f"{len(report['deferred'])} на повторе\n"
+            f"⏱ Доставка: первая {report['first']:.2f} сек., p50 {report['p50']:.2f} сек., "
+            f"p95 {report['p95']:.2f} сек., хвост {report['last']:.2f} сек."
+        )
+
+    async def poll_stock(self, application):
+        """Одна проверка стока: получение, сравнение и рассылка; True, если сток изменился"""
+        current_interval = getattr(self, 'check_interval', 30)
+        check_number = self.metrics.get('polls') + 1
+        logger.info(f"🔍 Проверка стока #{check_number} (интервал: {current_interval}сек)")
+        
+        # Снимок мог уже получить кто-то другой (например, /teststock), поэтому
+        # изменение определяется сравнением с последним обработанным снимком,
+        # а не по флагу конкретного запроса
+        current_stock = await self.get_stock(max_age=0)
+        self.metrics.incr('polls')
+        changed = current_stock is not None and current_stock is not self.diff_engine.previous
+        
+        if current_stock is None:
+            logger.warning(f"⚠️ Не удалось получить данные стока ({self.last_fetch_error})")
+            self.metrics.incr('poll_errors')
+            return False
             
-        message = self.format_stock_message(new_items)
-        if not message:
-            logger.warning("⚠️ Не удалось сформировать сообщение")
-            return
+        self.history.record(current_stock)
+        
+        if not changed:
+            # Ответ не изменился: парсинг, сравнение и подробные логи не нужны
+            logger.debug(f"💤 Проверка #{check_number} - ответ API не изменился")
+            return False
             
-        sent_count = 0
-        failed_channels = []
+        # Детальное логирование всех предметов
+        if logger.isEnabledFor(logging.DEBUG):
+            for category, items in current_stock.items():
+                for item_name, quantity in items.items():
+                    logger.debug(f"  🎯 {category}: {item_name} - {quantity} шт.")
         
-        logger.info(f"📨 Начинаем отправку в {len(self.approved_channels)} каналов")
+        restocked = {timer_category(key) for key in self.scheduler.pop_restocked()}
+        diff_started = time.perf_counter()
+        events = self.diff_engine.diff(current_stock, restocked)
+        self.metrics.observe('diff', (time.perf_counter() - diff_started) * 1000)
+        self.last_events = events
         
-        for channel_id, channel_info in list(self.approved_channels.items()):
-            try:
-                logger.info(f"🔄 Пытаемся отправить в канал: {channel_info['title']} (ID: {channel_id})")
-                
-                # Отправляем основное сообщение
-                sent_message = await application.bot.send_message(
-                    chat_id=channel_id, 
-                    text=message, 
-                    parse_mode='Markdown',
-                    disable_web_page_preview=True
-                )
-                
-                self.last_messages[str(channel_id)] = sent_message.message_id
-                sent_count += 1
-                
-                logger.info(f"✅ Сообщение отправлено в канал {channel_info['title']}")
-                await asyncio.sleep(2)  # Задержка между отправками
-                
-            except Exception as e:
-                error_msg = str(e)
-                logger.error(f"❌ Ошибка отправки в канал {channel_id}: {error_msg}")
-                
-                # Проверяем тип ошибки
-                if any(err in error_msg for err in ["Chat not found", "bot is not a member", "Forbidden", "unauthorized"]):
-                    failed_channels.append(channel_id)
-                    logger.warning(f"🗑️ Удаляем канал {channel_id} из одобренных")
+        if events:
+            # Табло перерисовываются по любым изменениям (в том числе исчезновениям)
+            self.boards.touch(self.board_channels())
         
-        # Удаляем проблемные каналы
-        for channel_id in failed_channels:
-            self.remove_approved_channel(channel_id)
+        if self.snapshot_restored_at is not None:
+            # Первый опрос после перезапуска: сверка с сохраненным снимком
+            logger.info(f"🔁 Сверка с сохраненным снимком: {len(events)} изменений")
+            self.snapshot_restored_at = None
         
-        if sent_count > 0:
-            self.stats['total_messages_sent'] += sent_count
-            self.save_json(STATS_FILE, self.stats)
-            logger.info(f"📊 Итог отправки: {sent_count} успешно, {len(failed_channels)} неудачно")
+        notify_events = [event for event in events if event.kind in NOTIFY_EVENTS]
+        if events:
+            kinds = collections.Counter(event.kind for event in events)
+            logger.info(f"🔔 Изменения стока: {dict(kinds)}")
+        
+        # Накопитель получает все события: исчезновение внутри окна отменяет появление
+        await self.coalescer.add(events)
+        if notify_events:
+            logger.info(f"🎁 События для рассылки: {[f'{event.name} ({event.kind})' for event in notify_events]}")
+        else:
+            logger.info(f"🔍 Проверка #{check_number} - новых предметов нет")
+            
+            # Логируем каждые 5 проверок
+            if check_number % 5 == 0:
+                tracked_in_stock = len(self.tracked.items.intersection(flatten_stock(current_stock)))
+                logger.info(f"📈 Статистика: В стоке отслеживаемых: {tracked_in_stock}/{len(self.tracked)}")
+        
+        # Пока события копятся, снимок сохранит emit_stock_updates после
+        # постановки рассылки в журнал
+        if not self.coalescer.pending:
+            self.save_stock_snapshot(current_stock)
+        return True
 
     async def check_stock_loop(self, application):
-        """Основной цикл проверки стока с настраиваемым интервалом"""
+        """Основной цикл проверки стока под наблюдением PollerSupervisor
+
+        Ошибка одной проверки не завершает цикл: пауза до следующей
+        определяется состоянием опроса (расписание рестоков, экспоненциальная
+        пауза с джиттером или открытый предохранитель). Ошибки запросов к API
+        учитывает fetch_stock, здесь - только непредвиденные исключения.
+        """
         logger.info("🔄 Запущен цикл проверки стока")
-        
-        check_count = 0
-        error_count = 0
+        self.application = application
         
         while True:
+            changed = False
             try:
-                current_interval = getattr(self, 'check_interval', 30)
-                logger.info(f"🔍 Проверка стока #{check_count + 1} (интервал: {current_interval}сек)")
-                
-                current_stock = await self.get_real_garden_stock()
-                
-                if current_stock:
-                    logger.info(f"📊 Получен сток: {len(current_stock)} предметов")
-                    
-                    # Детальное логирование всех предметов
-                    if current_stock:
-                        logger.info("📝 ДЕТАЛЬНЫЙ ОТЧЕТ О СТОКЕ:")
-                        for item_name, quantity in current_stock.items():
-                            status = "🎯 ОТСЛЕЖИВАЕТСЯ" if item_name in self.proctor_items else "👀 В стоке"
-                            logger.info(f"  {status}: {item_name} - {quantity} шт.")
-                    
-                    new_items = self.find_new_items(current_stock)
-                    
-                    if new_items:
-                        logger.info(f"🎁 Найдены новые предметы: {list(new_items.keys())}")
-                        logger.info(f"📨 Начинаю отправку в {len(self.approved_channels)} каналов")
-                        await self.send_stock_updates(application, new_items)
-                        error_count = 0
-                    else:
-                        check_count += 1
-                        logger.info(f"🔍 Проверка #{check_count} - новых предметов нет")
-                        
-                        # Логируем каждые 5 проверок
-                        if check_count % 5 == 0:
-                            tracked_in_stock = [item for item in self.proctor_items if item in current_stock]
-                            logger.info(f"📈 Статистика: В стоке отслеживаемых: {len(tracked_in_stock)}/{len(self.proctor_items)}")
-                            
-                else:
-                    logger.warning("⚠️ Не удалось получить данные стока")
-                    error_count += 1
-                    if error_count > 3:
-                        logger.error("🔄 Перезапускаем цикл проверки из-за множественных ошибок")
-                        # Сбрасываем last_stock при перезапуске
-                        self.last_stock = {}
-                        return await self.check_stock_loop(application)
-                
-                # Используем настраиваемый интервал
-                await asyncio.sleep(current_interval)
-                
+                changed = await self.poll_stock(application)
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 logger.error(f"❌ Ошибка в цикле проверки: {e}")
-                error_count += 1
-                await asyncio.sleep(60)
+                self.poller.record_failure(e)
+            
+            # Интервал подстраивается под таймеры рестока и состояние опроса
+            delay = self.poller.next_delay(self.scheduler.next_delay(getattr(self, 'check_interval', 30), changed))
+            logger.debug(f"⏳ Следующая проверка через {delay:.1f} сек. ({self.scheduler.mode}, {self.poller.state})")
+            await asyncio.sleep(delay)
 
     def get_bot_stats(self):
         """Получает статистику бота"""
@@ -586,13 +3471,32 @@ class GardenStockBot:
 🎯 Отслеживаемых предметов: {len(self.proctor_items)}
 ⏳ Заявок на рассмотрении: {len(self.pending_channels)}
 ⏰ Интервал проверки: {getattr(self, 'check_interval', 30)} сек.
+🔁 Проверок: {self.metrics.get('polls')} (без изменений: {self.metrics.get('polls_unchanged')}, ошибок: {self.metrics.get('poll_errors')})
+🗃 Кэш снимка ({getattr(self, 'snapshot_ttl', 15)} сек.): попаданий {self.metrics.get('snapshot_cache_hits')}, присоединений к запросу {self.metrics.get('snapshot_fetch_joins')}, таймаутов ожидания {self.metrics.get('snapshot_fetch_timeouts')}
+📨 Рассылок: {self.metrics.get('broadcasts')}, ошибок отправки: {self.metrics.get('send_failures')}
+{self.metrics.format_timings()}
+{self.poller.describe()}
+{self.scheduler.describe()}
+
+{self.http.format_metrics()}
+{self.writer.format_metrics()}
+{self.debug_capture.describe()}
+{self.history.describe()}
+{self.format_broadcast_report()}
+{self.broadcaster.describe()}
+{self.coalescer.describe()}
+{self.boards.describe()}
+{self.renderer.describe()}
+{self.metrics.format_slowest_channels() or ''}
 
 🟢 Статус: Активен
 🕒 Последняя проверка: {datetime.now().strftime('%H:%M:%S')}
         """
 
-# Создаем экземпляр бота
-bot = GardenStockBot()
+# Создаем экземпляр бота. Процессы доставки (ShardedBroadcaster, spawn)
+# заново импортируют этот файл как __mp_main__ - им бот не нужен
+if __name__ != '__mp_main__':
+    bot = GardenStockBot()
 
 # ========== ОБРАБОТЧИКИ КОМАНД ==========
 
@@ -647,6 +3551,11 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 ⚙️ *Управление каналами:*
 /approve <ID> - Одобрить канал
 /reject <ID> - Отклонить канал
+/setpriority <ID> <N> - Приоритет канала в рассылке
+/subscribe <ID> [item|category|min ...] - Подписка канала
+/unsubscribe <ID> item|category|all - Изменить подписку канала
+/board <ID> on|off - Живое табло вместо отдельных сообщений
+/setlocale <ID> ru|en - Язык сообщений канала
 
 👥 *Управление администраторами:*
 /addadmin <ID> - Добавить админа
@@ -657,11 +3566,15 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /additem <название> - Добавить предмет
 /removeitem <название> - Удалить предмет
 /setinterval <секунды> - Интервал проверки
+/setcoalesce <секунды> - Окно объединения событий
+/history <предмет> [дни] - История стока предмета
+/forecast <предмет> [дни] - Прогноз появления предмета
 
 🧪 *Тестовые команды:*
 /teststock - Тест проверки стока
 /testmessage <ID> - Тест отправки сообщения
 /resetstock - Сбросить память о стоке
+/debugcapture <режим> - Отладочные снимки API
 
 ❓ *Помощь:*
 /help - Полный список команд
@@ -938,15 +3851,14 @@ async def add_item_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Использование: /additem <название предмета>")
         return
         
-    item_name = ' '.join(context.args).lower().strip()
+    item_name = TrackedItemIndex.normalize(' '.join(context.args))
+    result = bot.add_tracked_item(item_name)
     
-    if item_name in bot.proctor_items:
-        await update.message.reply_text(f"❌ Предмет `{item_name}` уже отслеживается.")
+    if result is None:
+        await update.message.reply_text(f"❌ Предмет `{bot.tracked.resolve(item_name)}` уже отслеживается.")
         return
         
-    bot.proctor_items.append(item_name)
-    
-    if bot.save_proctor_items():
+    if result:
         await update.message.reply_text(f"✅ Предмет `{item_name}` добавлен для отслеживания!")
         logger.info(f"✅ Добавлен предмет для отслеживания: {item_name}")
     else:
@@ -964,15 +3876,14 @@ async def remove_item_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("❌ Использование: /removeitem <название предмета>")
         return
         
-    item_name = ' '.join(context.args).lower().strip()
+    item_name = bot.tracked.resolve(' '.join(context.args)) or TrackedItemIndex.normalize(' '.join(context.args))
+    result = bot.remove_tracked_item(item_name)
     
-    if item_name not in bot.proctor_items:
+    if result is None:
         await update.message.reply_text(f"❌ Предмет `{item_name}` не найден в списке отслеживания.")
         return
         
-    bot.proctor_items.remove(item_name)
-    
-    if bot.save_proctor_items():
+    if result:
         await update.message.reply_text(f"✅ Предмет `{item_name}` удален из отслеживания!")
         logger.info(f"✅ Удален предмет из отслеживания: {item_name}")
     else:
@@ -1006,6 +3917,299 @@ async def set_interval_command(update: Update, context: ContextTypes.DEFAULT_TYP
     await update.message.reply_text(f"✅ Интервал проверки установлен: {interval} секунд")
     logger.info(f"⏰ Установлен интервал проверки: {interval} сек.")
 
+async def set_coalesce_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Устанавливает окно объединения событий в одну рассылку"""
+    user_id = update.effective_user.id
+    
+    if not bot.is_whitelisted(user_id):
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+        
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text(f"{bot.coalescer.describe()}\n\nИспользование: /setcoalesce <секунды> (0 - выключить)")
+        return
+        
+    window = int(context.args[0])
+    
+    if window > 30:
+        await update.message.reply_text("❌ Окно не может быть больше 30 секунд.")
+        return
+        
+    bot.coalescer.window = window
+    bot.save_proctor_items()
+    
+    await update.message.reply_text(f"✅ {bot.coalescer.describe()}")
+    logger.info(f"🧺 Окно объединения событий: {window} сек.")
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает историю появлений предмета в стоке"""
+    user_id = update.effective_user.id
+    
+    if not bot.is_whitelisted(user_id):
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+        
+    if not context.args:
+        await update.message.reply_text("❌ Использование: /history <название предмета> [дни]")
+        return
+        
+    args = list(context.args)
+    days = 7
+    if len(args) > 1 and args[-1].isdigit():
+        days = min(max(int(args.pop()), 1), 365)
+    name = ' '.join(args)
+    # Предмет мог уже не отслеживаться, но остаться в истории
+    item = bot.tracked.resolve(name) or TrackedItemIndex.normalize(name)
+    
+    summary = await asyncio.get_running_loop().run_in_executor(None, bot.history.summarize, item, days)
+    
+    if not summary['polls']:
+        await update.message.reply_text(f"📜 Нет записей истории за {days} дн.")
+        return
+    if not summary['present']:
+        await update.message.reply_text(f"📜 `{item}` не появлялся в стоке за {days} дн. (опросов: {summary['polls']})")
+        return
+        
+    quantities = ', '.join(f"{quantity} шт. × {count}" for quantity, count in summary['quantities'].most_common(5))
+    hours = ', '.join(f"{hour:02d}:00 ({count})" for hour, count in summary['hours'].most_common(5))
+    last_seen = datetime.fromtimestamp(summary['last_seen']).strftime('%d.%m %H:%M')
+    await update.message.reply_text(
+        f"📜 История `{item}` за {days} дн.\n\n"
+        f"🔁 Опросов: {summary['polls']}, в стоке: {summary['present']} "
+        f"({summary['present'] / summary['polls']:.0%})\n"
+        f"🟢 Появлений: {summary['appearances']}\n"
+        f"📦 Количество при появлении: {quantities}\n"
+        f"🕒 Часы появлений (UTC): {hours}\n"
+        f"👀 Последний раз: {last_seen}"
+    )
+
+async def forecast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает статистику появлений предмета и прогноз на следующий рестокинг"""
+    user_id = update.effective_user.id
+    
+    if not bot.is_whitelisted(user_id):
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+        
+    if bot.analytics is None:
+        await update.message.reply_text("❌ Для прогноза нужен NumPy: pip install numpy")
+        return
+        
+    if not context.args:
+        await update.message.reply_text("❌ Использование: /forecast <название предмета> [дни]")
+        return
+        
+    args = list(context.args)
+    days = 14
+    if len(args) > 1 and args[-1].isdigit():
+        days = min(max(int(args.pop()), 1), 365)
+    name = ' '.join(args)
+    item = bot.tracked.resolve(name) or TrackedItemIndex.normalize(name)
+    
+    result = await asyncio.get_running_loop().run_in_executor(
+        None, bot.analytics.forecast, item, days, bot.restock_cycles()
+    )
+    
+    if not result['polls']:
+        await update.message.reply_text(f"📈 Нет записей истории за {days} дн.")
+        return
+        
+    lines = [
+        f"📈 Прогноз для `{item}` (история за {days} дн.)\n",
+        f"🔁 Опросов: {result['polls']}, в стоке {result['presence']:.1%} времени",
+        f"🟢 Появлений: {result['appearances']} (~{result['per_day']:.1f} в день)"
+    ]
+    if 'interval' in result:
+        p10, p50, p90 = (value / 60 for value in result['interval'])
+        lines.append(f"⏱ Между появлениями: медиана {p50:.0f} мин. (p10 {p10:.0f}, p90 {p90:.0f})")
+    if 'quantity' in result:
+        p10, p50, p90 = result['quantity']
+        lines.append(f"📦 Количество: медиана {p50:.0f} шт. (p10 {p10:.0f}, p90 {p90:.0f})")
+    if 'probability' in result:
+        lines.append(
+            f"🎲 Вероятность в следующем рестоке: {result['probability']:.0%} "
+            f"(циклов по {result['period'] // 60} мин.: {result['cycles']})"
+        )
+        if result['next_restock']:
+            lines.append(f"🕒 Следующий рестокинг через {max(0, result['next_restock'] - time.time()):.0f} сек.")
+    if result.get('last_seen'):
+        lines.append(f"👀 Последний раз: {datetime.fromtimestamp(result['last_seen']).strftime('%d.%m %H:%M')}")
+    lines.append(f"\n⚡ Расчет: {result['elapsed_ms']:.1f} мс")
+    
+    await update.message.reply_text('\n'.join(lines))
+
+async def set_priority_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Устанавливает приоритет канала в рассылке"""
+    user_id = update.effective_user.id
+    
+    if not bot.is_whitelisted(user_id):
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+        
+    if len(context.args) != 2 or not context.args[1].lstrip('-').isdigit():
+        await update.message.reply_text("❌ Использование: /setpriority <channel_id> <приоритет>")
+        return
+        
+    channel_id, priority = context.args[0], int(context.args[1])
+    
+    if bot.set_channel_priority(channel_id, priority):
+        await update.message.reply_text(f"✅ Приоритет канала `{channel_id}` установлен: {priority}")
+    else:
+        await update.message.reply_text("❌ Канал не найден среди одобренных.")
+
+async def set_locale_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Устанавливает язык сообщений канала"""
+    user_id = update.effective_user.id
+    
+    if not bot.is_whitelisted(user_id):
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+        
+    locales = '|'.join(MESSAGE_TEMPLATES)
+    if len(context.args) != 2 or context.args[1].lower() not in MESSAGE_TEMPLATES:
+        await update.message.reply_text(f"❌ Использование: /setlocale <channel_id> <{locales}>")
+        return
+        
+    channel_id, locale = context.args[0], context.args[1].lower()
+    
+    if not bot.set_channel_locale(channel_id, locale):
+        await update.message.reply_text("❌ Канал не найден среди одобренных.")
+        return
+        
+    if bot.approved_channels[channel_id].get('board'):
+        bot.application = bot.application or context.application
+        bot.boards.touch([channel_id])
+    await update.message.reply_text(f"✅ Язык сообщений канала `{channel_id}`: {locale}")
+
+async def board_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Включает или выключает живое табло канала"""
+    user_id = update.effective_user.id
+    
+    if not bot.is_whitelisted(user_id):
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+        
+    if len(context.args) != 2 or context.args[1].lower() not in ('on', 'off'):
+        await update.message.reply_text("❌ Использование: /board <channel_id> on|off")
+        return
+        
+    channel_id, enabled = context.args[0], context.args[1].lower() == 'on'
+    
+    if not bot.set_channel_board(channel_id, enabled):
+        await update.message.reply_text("❌ Канал не найден среди одобренных.")
+        return
+        
+    if enabled:
+        bot.application = bot.application or context.application
+        bot.boards.touch([channel_id])
+        await update.message.reply_text(
+            f"✅ Живое табло в канале `{channel_id}` включено. Сообщение будет опубликовано и закреплено, "
+            "дальше оно только редактируется."
+        )
+    else:
+        await update.message.reply_text(f"✅ Живое табло в канале `{channel_id}` выключено, канал снова получает отдельные сообщения.")
+
+async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Настраивает подписку канала: предметы, категории, минимальное количество"""
+    user_id = update.effective_user.id
+    
+    if not bot.is_whitelisted(user_id):
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+        
+    usage = (
+        "❌ Использование:\n"
+        "/subscribe <channel_id> - показать подписку\n"
+        "/subscribe <channel_id> item <предмет> - добавить предмет\n"
+        "/subscribe <channel_id> category <eggs|seeds|gear|...> - добавить категорию\n"
+        "/subscribe <channel_id> min <количество> - минимальное количество\n"
+        "/unsubscribe <channel_id> item|category <название> - убрать из подписки\n"
+        "/unsubscribe <channel_id> all - получать все предметы"
+    )
+    if not context.args:
+        await update.message.reply_text(usage)
+        return
+        
+    channel_id = context.args[0]
+    if channel_id not in bot.approved_channels:
+        await update.message.reply_text("❌ Канал не найден среди одобренных.")
+        return
+        
+    if len(context.args) == 1:
+        await update.message.reply_text(f"🔖 Подписка канала `{channel_id}`: {bot.describe_subscription(channel_id)}")
+        return
+        
+    kind, value = context.args[1].lower(), ' '.join(context.args[2:])
+    subscription = dict(bot.approved_channels[channel_id].get('subscription') or {})
+    
+    if kind == 'item':
+        item = bot.tracked.resolve(value)
+        if item is None:
+            await update.message.reply_text(f"❌ Предмет `{value}` не отслеживается. Добавьте его через /additem")
+            return
+        subscription['items'] = sorted(set(subscription.get('items', [])) | {item})
+    elif kind == 'category':
+        category = parse_category(value)
+        if category is None:
+            await update.message.reply_text(f"❌ Неизвестная категория. Доступны: {', '.join(STOCK_CATEGORIES)}")
+            return
+        subscription['categories'] = sorted(set(subscription.get('categories', [])) | {category})
+    elif kind == 'min' and value.isdigit() and int(value) >= 1:
+        subscription['min_quantity'] = int(value)
+    else:
+        await update.message.reply_text(usage)
+        return
+        
+    if bot.set_channel_subscription(channel_id, subscription):
+        await update.message.reply_text(f"✅ Подписка канала `{channel_id}`: {bot.describe_subscription(channel_id)}")
+    else:
+        await update.message.reply_text("❌ Не удалось сохранить подписку.")
+
+async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Убирает предмет или категорию из подписки канала"""
+    user_id = update.effective_user.id
+    
+    if not bot.is_whitelisted(user_id):
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+        
+    if len(context.args) < 2:
+        await update.message.reply_text("❌ Использование: /unsubscribe <channel_id> item|category <название> или /unsubscribe <channel_id> all")
+        return
+        
+    channel_id = context.args[0]
+    if channel_id not in bot.approved_channels:
+        await update.message.reply_text("❌ Канал не найден среди одобренных.")
+        return
+        
+    kind, value = context.args[1].lower(), ' '.join(context.args[2:])
+    subscription = dict(bot.approved_channels[channel_id].get('subscription') or {})
+    
+    if kind == 'all':
+        subscription = None
+    elif kind == 'item':
+        name = bot.tracked.resolve(value) or TrackedItemIndex.normalize(value)
+        subscription['items'] = [item for item in subscription.get('items', []) if item != name]
+    elif kind == 'category':
+        category = parse_category(value)
+        subscription['categories'] = [c for c in subscription.get('categories', []) if c != category]
+    else:
+        await update.message.reply_text("❌ Использование: /unsubscribe <channel_id> item|category <название> или /unsubscribe <channel_id> all")
+        return
+        
+    if subscription is not None and not subscription.get('items') and not subscription.get('categories'):
+        # Пустая подписка означает "все предметы" - отписка не должна расширять рассылку
+        await update.message.reply_text(
+            "❌ В подписке не останется предметов и категорий, а такой канал получает все предметы. "
+            f"Добавьте другие через /subscribe или используйте /unsubscribe {channel_id} all"
+        )
+        return
+        
+    if bot.set_channel_subscription(channel_id, subscription):
+        await update.message.reply_text(f"✅ Подписка канала `{channel_id}`: {bot.describe_subscription(channel_id)}")
+    else:
+        await update.message.reply_text("❌ Не удалось сохранить подписку.")
+
 async def test_stock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Тестовая команда для проверки стока"""
     user_id = update.effective_user.id
@@ -1016,20 +4220,57 @@ async def test_stock_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
     await update.message.reply_text("🔍 Запускаю тестовую проверку стока...")
     
-    current_stock = await bot.get_real_garden_stock()
+    current_stock, age = await bot.get_real_garden_stock()
     
-    if current_stock:
-        stock_text = "📊 ТЕКУЩИЙ СТОК:\n\n"
-        for item_name, quantity in current_stock.items():
-            status = "🎯" if item_name in bot.proctor_items else "👀"
-            stock_text += f"{status} `{item_name}` - {quantity} шт.\n"
-        
-        tracked_count = len([item for item in bot.proctor_items if item in current_stock])
-        stock_text += f"\n📈 Отслеживаемых в стоке: {tracked_count}/{len(bot.proctor_items)}"
+    if age is None:
+        await update.message.reply_text(f"❌ Не удалось получить данные стока ({bot.last_fetch_error})")
+        return
         
-        await update.message.reply_text(stock_text)
+    if age > getattr(bot, 'snapshot_ttl', 15):
+        stock_text = f"📊 СТОК ИЗ КЭША (устарел на {age:.0f} сек., API: {bot.poller.state}):\n\n"
     else:
-        await update.message.reply_text("❌ Не удалось получить данные стока")
+        stock_text = f"📊 ТЕКУЩИЙ СТОК (обновлен {age:.0f} сек. назад):\n\n"
+    for item_name, quantity in current_stock.items():
+        status = "🎯" if item_name in bot.tracked.items else "👀"
+        stock_text += f"{status} `{item_name}` - {quantity} шт.\n"
+    
+    tracked_count = len(bot.tracked.items.intersection(current_stock))
+    stock_text += f"\n📈 Отслеживаемых в стоке: {tracked_count}/{len(bot.tracked)}"
+    
+    await update.message.reply_text(stock_text)
+
+async def debug_capture_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Настраивает сохранение отладочных снимков ответа API"""
+    user_id = update.effective_user.id
+    
+    if not bot.is_whitelisted(user_id):
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+        
+    if not context.args:
+        await update.message.reply_text(
+            f"{bot.debug_capture.describe()}\n\n"
+            "Использование: /debugcapture <off|change|error|every N>"
+        )
+        return
+        
+    mode = context.args[0].lower()
+    
+    if mode not in DebugCapture.MODES:
+        await update.message.reply_text("❌ Режим должен быть одним из: off, change, error, every N")
+        return
+        
+    if mode == 'every':
+        if len(context.args) < 2 or not context.args[1].isdigit() or int(context.args[1]) < 1:
+            await update.message.reply_text("❌ Использование: /debugcapture every <N>")
+            return
+        bot.debug_capture.every = int(context.args[1])
+        
+    bot.debug_capture.mode = mode
+    bot.save_proctor_items()
+    
+    await update.message.reply_text(f"✅ {bot.debug_capture.describe()}")
+    logger.info(f"🐞 Режим отладочных снимков: {mode}")
 
 async def test_message_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Тестовая команда для отправки сообщения"""
@@ -1070,7 +4311,7 @@ async def reset_stock_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("❌ У вас нет доступа к этой команде.")
         return
         
-    bot.last_stock = {}
+    bot.reset_stock_memory()
     await update.message.reply_text("✅ Память о предыдущем стоке сброшена! Следующая проверка покажет все предметы как новые.")
     logger.info("🔄 Память о стоке сброшена администратором")
 
@@ -1111,6 +4352,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 ⚙️ УПРАВЛЕНИЕ КАНАЛАМИ:
 /approve <ID> - Одобрить канал
 /reject <ID> - Отклонить канал
+/setpriority <ID> <N> - Приоритет канала в рассылке
+/subscribe <ID> [item|category|min ...] - Подписка канала
+/unsubscribe <ID> item|category|all - Изменить подписку канала
+/board <ID> on|off - Живое табло вместо отдельных сообщений
+/setlocale <ID> ru|en - Язык сообщений канала
 
 👥 УПРАВЛЕНИЕ АДМИНИСТРАТОРАМИ:
 /addadmin <ID> - Добавить администратора
@@ -1121,11 +4367,15 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /additem <название> - Добавить предмет для отслеживания
 /removeitem <название> - Удалить предмет из отслеживания
 /setinterval <секунды> - Установить интервал проверки
+/setcoalesce <секунды> - Окно объединения событий в одну рассылку (0 - выключить)
+/history <предмет> [дни] - История появлений предмета (по умолчанию 7 дней)
+/forecast <предмет> [дни] - Частота, количества и вероятность в следующем рестоке (нужен NumPy)
 
 🧪 ТЕСТОВЫЕ КОМАНДЫ:
 /teststock - Проверить текущий сток
 /testmessage <ID> - Отправить тестовое сообщение
 /resetstock - Сбросить память о стоке
+/debugcapture <режим> - Отладочные снимки API (off/change/error/every N)
 
 📝 ПРОЦЕСС ПОДКЛЮЧЕНИЯ:
 1. Пользователь использует /request
@@ -1309,6 +4559,11 @@ def setup_handlers(application):
     application.add_handler(CommandHandler("pending", pending_command))
     application.add_handler(CommandHandler("approve", approve_command))
     application.add_handler(CommandHandler("reject", reject_command))
+    application.add_handler(CommandHandler("setpriority", set_priority_command))
+    application.add_handler(CommandHandler("subscribe", subscribe_command))
+    application.add_handler(CommandHandler("board", board_command))
+    application.add_handler(CommandHandler("setlocale", set_locale_command))
+    application.add_handler(CommandHandler("unsubscribe", unsubscribe_command))
     application.add_handler(CommandHandler("help", help_command))
     
     # Команды управления администраторами
@@ -1321,11 +4576,15 @@ def setup_handlers(application):
     application.add_handler(CommandHandler("additem", add_item_command))
     application.add_handler(CommandHandler("removeitem", remove_item_command))
     application.add_handler(CommandHandler("setinterval", set_interval_command))
+    application.add_handler(CommandHandler("setcoalesce", set_coalesce_command))
+    application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("forecast", forecast_command))
     
     # Тестовые команды
     application.add_handler(CommandHandler("teststock", test_stock_command))
     application.add_handler(CommandHandler("testmessage", test_message_command))
     application.add_handler(CommandHandler("resetstock", reset_stock_command))
+    application.add_handler(CommandHandler("debugcapture", debug_capture_command))
     
     # Обработчик данных заявки
     application.add_handler(MessageHandler(
@@ -1342,11 +4601,38 @@ def setup_handlers(application):
 async def start_stock_checker(application):
     """Запускает проверку стока в фоне"""
     await asyncio.sleep(5)  # Ждем немного перед запуском
+    if bot.analytics is not None:
+        # Кэш аналитики прогревается в фоне, пока идут проверки
+        asyncio.get_running_loop().run_in_executor(None, bot.analytics.warm)
     await bot.check_stock_loop(application)
 
+async def on_shutdown(application):
+    """Останавливает фоновые задачи и закрывает HTTP клиент при остановке приложения"""
+    if bot.stock_check_task and not bot.stock_check_task.done():
+        bot.stock_check_task.cancel()
+        try:
+            await bot.stock_check_task
+        except asyncio.CancelledError:
+            pass
+    # Отложенные пачки и правки табло не должны снова запустить рассылку после stop()
+    await bot.coalescer.close()
+    await bot.boards.close()
+    # Итоги недоставленных рассылок не нужны: сами сообщения остаются в журнале
+    broadcast_tasks = list(bot.broadcast_tasks)
+    for task in broadcast_tasks:
+        task.cancel()
+    await asyncio.gather(*broadcast_tasks, return_exceptions=True)
+    await bot.broadcaster.stop()
+    await bot.http.close()
+    await bot.metrics.flush()
+    await bot.writer.drain()
+    bot.writer.close()
+    bot.store.close()
+
 def main():
     """Запуск бота"""
     try:
+        import config
         from config import BOT_TOKEN
         
         # Запускаем веб-сервер в отдельном потоке для Replit
@@ -1354,14 +4640,20 @@ def main():
         logger.info("🌐 Веб-сервер запущен на порту 8080")
         
         # Создаем приложение с Job Queue
-        application = Application.builder().token(BOT_TOKEN).build()
+        builder = Application.builder().token(BOT_TOKEN).post_shutdown(on_shutdown)
+        # TELEGRAM_API_URL в config.py - другой Bot API сервер (например, fake_telegram.py)
+        api_url = getattr(config, 'TELEGRAM_API_URL', None)
+        if api_url:
+            builder = builder.base_url(api_url)
+            logger.info(f"🧪 Bot API: {api_url}")
+        application = builder.build()
         
         # Настраиваем обработчики
         setup_handlers(application)
         
         # Запускаем проверку стока в фоне
         loop = asyncio.get_event_loop()
-        loop.create_task(start_stock_checker(application))
+        bot.stock_check_task = loop.create_task(start_stock_checker(application))
         
         # Запускаем бота
         logger.info("🌿 Запускаем Garden Stock Bot...")